@@ -0,0 +1,187 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Persistent caches kept in the bob lookaside directory.
+'''
+
+import cPickle
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from conary.lib.util import mkdirChain
+
+from bob.util import LockFile
+
+log = logging.getLogger('bob.cache')
+
+
+class DiskCache(object):
+    '''
+    A directory of pickled values indexed by arbitrary string keys. Once the
+    total size of the entries exceeds C{maxSize} bytes, the least recently
+    used ones are evicted. Writers hold an exclusive lock on the directory so
+    that concurrent bobs sharing a lookaside do not trample each other.
+
+    The directory is only listed on the first write and once the running
+    total goes over the limit, which also picks up entries written by other
+    processes in the meantime. Eviction then frees a quarter of the space so
+    that the next few writes don't have to list it again.
+    '''
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        # See LockFile
+        self._lock = threading.Lock()
+        # Size of each entry written or seen by this process
+        self._sizes = None
+        self._total = 0
+
+    def _entryPath(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        '''
+        Return the value stored for C{key}, or C{None} if there is none.
+        '''
+        path = self._entryPath(key)
+        try:
+            fobj = open(path, 'rb')
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        with fobj:
+            try:
+                value = cPickle.load(fobj)
+            except Exception:
+                log.warning("Ignoring corrupt cache entry %s", path)
+                return None
+        try:
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        '''
+        Store C{value} for C{key}, evicting old entries if needed.
+        '''
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxSize:
+            return
+        mkdirChain(self.path)
+        with self._lock, LockFile(os.path.join(self.path, 'lock')):
+            if self._sizes is None:
+                self._setSizes(self._scan())
+            fd, tmpPath = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as fobj:
+                fobj.write(data)
+            path = self._entryPath(key)
+            os.rename(tmpPath, path)
+            self._total += len(data) - self._sizes.get(path, 0)
+            self._sizes[path] = len(data)
+            if self._total > self.maxSize:
+                self._evict()
+
+    def _scan(self):
+        '''
+        Return C{(mtime, size, path)} for each entry, oldest first.
+        '''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.') or name == 'lock':
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def _setSizes(self, entries):
+        self._sizes = dict((path, size) for _, size, path in entries)
+        self._total = sum(self._sizes.itervalues())
+
+    def _evict(self):
+        entries = self._scan()
+        total = sum(x[1] for x in entries)
+        if total <= self.maxSize:
+            self._setSizes(entries)
+            return
+        while total > self.maxSize * 3 // 4 and entries:
+            _, size, path = entries.pop(0)
+            log.debug("Evicting cache entry %s", path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self._setSizes(entries)
+
+
+class BuildHistory(object):
+    '''
+    How long each source took to build the last time it was built, kept in
+    a JSON file so that later runs can start the slowest builds first.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''
+        Return a dictionary mapping source names to build times in seconds.
+        '''
+        try:
+            with open(self.path) as fobj:
+                data = json.load(fobj)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return {}
+        except ValueError:
+            log.warning("Ignoring corrupt build history %s", self.path)
+            return {}
+        return dict((str(name), float(seconds))
+                for name, seconds in data.iteritems())
+
+    def record(self, durations):
+        '''
+        Merge C{durations}, a dictionary mapping source names to build times
+        in seconds, into the history.
+        '''
+        if not durations:
+            return
+        dirName = os.path.dirname(self.path)
+        mkdirChain(dirName)
+        with LockFile(self.path + '.lock'):
+            data = self.load()
+            data.update(durations)
+            fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(data, fobj, indent=1, sort_keys=True)
+            os.rename(tmpPath, self.path)
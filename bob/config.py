@@ -21,7 +21,8 @@ from conary.build.macros import Macros
 from conary.conarycfg import CfgFlavor
 from conary.lib import cfg
 from conary.lib.cfgtypes import CfgList, CfgString, CfgDict, CfgPath
-from conary.lib.cfgtypes import CfgQuotedLineList, CfgBool, ParseError
+from conary.lib.cfgtypes import CfgQuotedLineList, CfgBool, CfgInt
+from conary.lib.cfgtypes import ParseError
 from conary.versions import Label
 from rmake.build.buildcfg import CfgDependency
 
@@ -71,8 +72,55 @@ class BobConfig(cfg.SectionedConfigFile):
     scm                     = CfgDict(CfgString)    # macros supported
     refreshSources          = (CfgBool, False)
     wmsBase                 = CfgString
+    wmsMaxConnections       = (CfgInt, 4,
+            "Maximum number of concurrent connections to each WMS host.")
+    scmWorkers              = (CfgInt, 1,
+            "Number of SCM fetches and recipe extractions to run at once.")
+    scmFetchInterval        = (CfgInt, 0,
+            "Skip refreshing SCM caches of repositories that are not pinned "
+            "to an exact revision if they were fetched less than this many "
+            "seconds ago.")
+    shallowScm              = (CfgList(CfgString), [],
+            "Aliases of git SCM repositories to cache with shallow fetches "
+            "of just the needed revision.")
+    recipeCacheSize         = (CfgInt, 0,
+            "Size limit in megabytes of the on-disk cache of recipes "
+            "extracted from exact SCM revisions. 0 (the default) disables "
+            "the cache.")
+
+    recipeMetadataCacheSize = (CfgInt, 0,
+            "Size limit in megabytes of the on-disk cache of loaded recipe "
+            "metadata. Superclasses loaded from the repository are not part "
+            "of the cache key, so this is off (0) by default.")
+    loadWorkers             = (CfgInt, 1,
+            "Number of processes used to load recipes.")
+    snapshotWorkers         = (CfgInt, 1,
+            "Number of threads used to fetch autosource snapshots.")
+    streamCommit            = (CfgBool, False,
+            "Commit source changesets without first saving a copy in the "
+            "current directory. A copy is still saved if the commit fails.")
+    commitChunkTroves       = (CfgInt, 0,
+            "Commit source troves in changesets of at most this many troves. "
+            "0 commits all of them at once.")
+    commitChunkSize         = (CfgInt, 0,
+            "Start a new source changeset once the file contents in one "
+            "reach this many megabytes. 0 disables the limit.")
+    commitWorkers           = (CfgInt, 1,
+            "Number of source changeset chunks committed at once.")
 
     # build
+    pipelineBatches         = (CfgInt, 0,
+            "Start building each group as soon as the packages it includes "
+            "are committed, with up to this many rMake jobs running at once. "
+            "0 or 1 builds one level of the group tree at a time. Pipelined "
+            "jobs are polled instead of monitored, so only job state changes "
+            "are shown and showBuildLogs has no effect.")
+    incremental             = (CfgBool, False,
+            "Don't rebuild unchanged sources that already have binaries on "
+            "the target label in the needed flavors.")
+    asyncCommit             = (CfgBool, False,
+            "When pipelining batches, commit finished jobs in the background "
+            "while other jobs keep building.")
     installLabelPath        = CfgQuotedLineList(
                                 CfgString)          # macros supported
     needWmsToken            = CfgBool
@@ -26,6 +26,7 @@ import sys
 import time
 
 from conary.build.macros import Macros
+from rmake.build import buildjob
 from rmake.cmdline import monitor
 
 from bob import commit
@@ -39,11 +40,19 @@ from bob.util import partial, pushStopHandler, popStopHandler
 log = logging.getLogger('bob.cook')
 
 
-def stopJob(batch, signum, _):
+def stopJob(batch, signum, frame):
     '''
     Signal handler used during a cook job that will stop the job
     and exit.
     '''
+    stopJobs([batch], signum, frame)
+
+
+def stopJobs(batches, signum, _):
+    '''
+    Signal handler used while several cook jobs are running that will stop
+    all of them and exit.
+    '''
 
     # For some reason stopping the job tends to hang, especially when
     # terminated by jenkins, and it gets worse when we get stuck connecting to
@@ -62,12 +71,57 @@ def stopJob(batch, signum, _):
             os._exit(0)
 
     log.error('Caught signal %d during build; stopping job', signum)
-    batch.stop()
+    for batch in list(batches):
+        batch.stop()
     os.kill(pid, signal.SIGTERM)
     os.waitpid(pid, 0)
     sys.exit('Signalled stop')
 
 
+def _findExistingBuild(bobTrove, available, buildFlavor):
+    '''
+    Return the trove tuples of the packages or groups built from the
+    downstream version of I{bobTrove} that best match I{buildFlavor}, as
+    found in I{available}, the result of a C{getTroveVersionsByBranch} query.
+    The tuple of the package or group named after the source comes first.
+    Returns C{None} if that one has no matching build.
+    '''
+    sourceVersion = bobTrove.getDownstreamVersion()
+    strongFlavor = buildFlavor.toStrongFlavor()
+    # A biarch x86_64 build flavor also satisfies x86 binaries, so check that
+    # the binary was built for the same architecture. Binaries without an
+    # instruction set fit any build.
+    buildArch = flavors.get_major_arch(buildFlavor)
+
+    def bestMatch(name, versions):
+        matches = [(strongFlavor.score(flavor), version, flavor)
+                for version, builtFlavors in versions
+                for flavor in builtFlavors
+                if version.getSourceVersion() == sourceVersion
+                and strongFlavor.satisfies(flavor)
+                and flavors.get_major_arch(flavor) in (None, buildArch)]
+        if not matches:
+            return None
+        _, version, flavor = max(matches, key=lambda x: x[:2])
+        return (name, version, flavor)
+
+    mainName = bobTrove.getPackageName()
+    mainTup = bestMatch(mainName, available.get(mainName, {}).iteritems())
+    if mainTup is None:
+        return None
+    # Everything built by the same job shares the version of the main trove
+    result = [mainTup]
+    for name in bobTrove.getBinaryNames():
+        if name == mainName:
+            continue
+        builtFlavors = available.get(name, {}).get(mainTup[1])
+        if builtFlavors:
+            tup = bestMatch(name, [(mainTup[1], builtFlavors)])
+            if tup is not None:
+                result.append(tup)
+    return result
+
+
 class Batch(object):
     '''
     A batch of troves to be built at once; e.g. packages or groups. A
@@ -82,21 +136,40 @@ class Batch(object):
         # setup
         self._contextCache = ContextCache(self._helper.cfg)
         self._bobTroves = []
-        self._troves = set()
+        # Ordered, since rMake starts troves in the order they are given
+        self._troves = []
+        # Existing builds used instead of building, in the same form as a
+        # commit mapping
+        self._reused = {}
+        # Troves that may have existing builds, looked up all at once by
+        # _resolveExisting
+        self._candidates = []
 
         # job state
         self._jobId = None
+        self._jobState = None
+        self._doneJob = None
 
         # results
         self._testSuite = None
         self._coverageData = None
+        self._durations = {}
 
     def isEmpty(self):
         """
         Returns C{True} if there are no troves in this job.
         """
+        self._resolveExisting()
         return not self._troves
 
+    def hasWork(self):
+        """
+        Returns C{True} if there are troves to build or existing builds to
+        report.
+        """
+        self._resolveExisting()
+        return bool(self._troves or self._reused)
+
     def addTrove(self, bobTrove):
         '''
         Add a I{BobPackage} to the batch.
@@ -138,6 +211,9 @@ class Batch(object):
             log.debug('Package %s will be built in %d flavors',
                 bobTrove.getPackageName(), len(newFlavors))
 
+        reusable = (self._helper.plan.incremental and bobTrove.sourceReused
+                and not bobTrove.childrenRebuilt)
+
         for buildFlavor in newFlavors:
             # Calculate build parameters
             searchFlavors = flavors.guess_search_flavors(buildFlavor)
@@ -146,10 +222,69 @@ class Batch(object):
             context = self._contextCache.get(buildFlavor, searchFlavors,
                 macros)
 
-            # Add the tuple to the build list
-            self._bobTroves.append(bobTrove)
-            self._troves.add((bobTrove.getName(),
-                bobTrove.getDownstreamVersion(), buildFlavor, context))
+            if reusable:
+                self._candidates.append((bobTrove, buildFlavor, context))
+            else:
+                self._addBuild(bobTrove, buildFlavor, context)
+
+    def _addBuild(self, bobTrove, buildFlavor, context):
+        # Add the tuple to the build list
+        self._bobTroves.append(bobTrove)
+        troveTup = (bobTrove.getName(), bobTrove.getDownstreamVersion(),
+                buildFlavor, context)
+        if troveTup not in self._troves:
+            self._troves.append(troveTup)
+
+    def _resolveExisting(self):
+        '''
+        Look up existing builds of all the troves added since the last call
+        that may not need to be built, using one repository query for the
+        whole batch. Those without a matching build are added to the build
+        list.
+        '''
+        if not self._candidates:
+            return
+        candidates, self._candidates = self._candidates, []
+        repos = self._helper.getRepos()
+
+        query = {}
+        for bobTrove, _, _ in candidates:
+            branch = bobTrove.getDownstreamVersion().branch()
+            for name in bobTrove.getBinaryNames():
+                query.setdefault(name, {})[branch] = None
+        available = repos.getTroveVersionsByBranch(query)
+
+        chosen = []
+        for bobTrove, buildFlavor, context in candidates:
+            builtTups = _findExistingBuild(bobTrove, available, buildFlavor)
+            if builtTups is None:
+                self._addBuild(bobTrove, buildFlavor, context)
+                continue
+            log.info("Package %s=%s[%s] is already built",
+                    bobTrove.getPackageName(), builtTups[0][1],
+                    builtTups[0][2])
+            sourceTup = (bobTrove.getName(), bobTrove.getDownstreamVersion(),
+                    buildFlavor, context)
+            chosen.append((sourceTup, builtTups))
+        if not chosen:
+            return
+
+        # Groups are reported by themselves, but packages are reported along
+        # with their components like a commit would.
+        packageTups = sorted(set(tup for _, builtTups in chosen
+            for tup in builtTups if not tup[0].startswith('group-')))
+        components = {}
+        for tup, trv in zip(packageTups,
+                repos.getTroves(packageTups, withFiles=False)):
+            components[tup] = sorted(x for x in
+                    trv.iterTroveList(strongRefs=True)
+                    if x[0].startswith(tup[0] + ':'))
+        for sourceTup, builtTups in chosen:
+            result = []
+            for tup in builtTups:
+                result.append(tup)
+                result.extend(components.get(tup, []))
+            self._reused[sourceTup] = result
 
     def run(self, main):
         '''
@@ -157,6 +292,33 @@ class Batch(object):
         process the resulting artifacts, and commit if no errors or
         failed tests were encountered.
         '''
+        if self.isEmpty():
+            # Everything was built already
+            return self.commit()
+        jobId = self.start(main)
+
+        # Set a signal handler so we can stop the job if we get
+        # interrupted
+        pushStopHandler(partial(stopJob, self))
+
+        # Watch build (to stdout)
+        monitor.monitorJob(self._helper.getrMakeClient(), jobId,
+            exitOnFinish=True, displayClass=StatusOnlyDisplay,
+            showBuildLogs=self._helper.plan.showBuildLogs)
+
+        # Remove the signal handler now that the job is done
+        popStopHandler()
+
+        return self.finish()
+
+    def start(self, main):
+        '''
+        Create and start a rMake build job from the set of added troves,
+        and return its job ID without waiting for it. Returns C{None} if
+        there is nothing to build.
+        '''
+        if self.isEmpty():
+            return None
 
         troveNames = sorted(set(x[0].split(':')[0] for x in self._troves))
         log.info('Creating build job: %s', ' '.join(troveNames))
@@ -168,7 +330,7 @@ class Batch(object):
         # because otherwise rmake would wait for one flavor to build before
         # starting the other flavor due to dep confusion.
         cfg.isolateTroves = len(set(x[0] for x in self._troves)) == 1
-        job = self._helper.getrMakeHelper().createBuildJob(list(self._troves),
+        job = self._helper.getrMakeHelper().createBuildJob(self._troves,
                 buildConfig=cfg)
         jobId = self._helper.getrMakeClient().buildJob(job)
         log.info('Job %d started with these sources:', jobId)
@@ -177,24 +339,47 @@ class Batch(object):
             log.info(' %s=%s/%s', trove.getName(),
                     version.trailingLabel(), version.trailingRevision())
 
-        # Set a signal handler so we can stop the job if we get
-        # interrupted
         self._jobId = jobId
-        pushStopHandler(partial(stopJob, self))
 
-        # Watch build (to stdout)
         self._helper.callClientHook('client_preCommand', main,
             None, (self._helper.cfg, self._helper.cfg),
             None, None)
         self._helper.callClientHook('client_preCommand2', main,
             self._helper.getrMakeHelper(), None)
-        monitor.monitorJob(self._helper.getrMakeClient(), jobId,
-            exitOnFinish=True, displayClass=StatusOnlyDisplay,
-            showBuildLogs=self._helper.plan.showBuildLogs)
+        return jobId
 
-        # Remove the signal handler now that the job is done
-        self._jobId = None
-        popStopHandler()
+    def poll(self):
+        '''
+        Return C{True} if the job started by L{start} is no longer running.
+        '''
+        if self._jobId is None:
+            return True
+        job = self._helper.getrMakeClient().getJob(self._jobId,
+                withTroves=False)
+        if job.state != self._jobState:
+            # There is no monitor display when jobs are polled, so at least
+            # report each job's progress through its states
+            self._jobState = job.state
+            log.info('Job %d is %s', self._jobId,
+                    buildjob.stateNames.get(job.state, job.state))
+        return job.isFinished() or job.isFailed()
+
+    def finish(self):
+        '''
+        Process the artifacts of the job started by L{start} once it is done,
+        and commit if no errors or failed tests were encountered.
+        '''
+        self.check()
+        return self.commit()
+
+    def check(self):
+        '''
+        Process the artifacts of the job started by L{start} once it is done,
+        raising an error if it failed or any tests failed.
+        '''
+        if self.isEmpty():
+            return
+        jobId, self._jobId = self._jobId, None
 
         # Pull out logs
         job = self._helper.getrMakeClient().getJob(jobId)
@@ -226,20 +411,43 @@ class Batch(object):
             log.error('Job %d is already committing ' \
                 '(probably to the wrong place)', jobId)
             raise JobFailedError(jobId=jobId, why='Job already committing')
+        self._doneJob = job
+
+    def commit(self, helper=None):
+        '''
+        Commit the job checked by L{check} to the target repository and
+        return the mapping of committed troves. C{helper} is used instead of
+        the batch's own helper if given, e.g. when committing from another
+        thread.
+
+        Existing builds used instead of building are included in the
+        mapping under the job ID C{None}.
+        '''
+        mapping = {}
+        if self._reused:
+            mapping[None] = dict(self._reused)
+        if self.isEmpty():
+            return mapping
+
+        if helper is None:
+            helper = self._helper
+        job, self._doneJob = self._doneJob, None
+        jobId = job.jobId
 
         startTime = time.time()
         log.info('Starting commit of job %d', jobId)
-        self._helper.getrMakeClient().startCommit([jobId])
+        helper.getrMakeClient().startCommit([jobId])
 
         try:
-            mapping = commit.commit(self._helper, job)
+            jobMapping = commit.commit(helper, job)
         except Exception, e_value:
-            self._helper.getrMakeClient().commitFailed([jobId], str(e_value))
+            helper.getrMakeClient().commitFailed([jobId], str(e_value))
             raise
         else:
-            self._helper.getrMakeClient().commitSucceeded(mapping)
+            helper.getrMakeClient().commitSucceeded(jobMapping)
             log.info('Commit of job %d completed in %.02f seconds',
                 jobId, time.time() - startTime)
+        mapping.update(jobMapping)
         return mapping
 
     def stop(self):
@@ -266,13 +474,29 @@ class Batch(object):
         '''
         return self._coverageData
 
+    def getDurations(self):
+        '''
+        Retrieve how long each source took to build, in seconds, after a
+        batch is run. Of several flavors, the slowest one counts.
+
+        @rtype: C{dict([(sourceName, seconds)])}
+        '''
+        return self._durations
+
     def writeLogs(self, job):
         """
-        Write build logs for job C{job} to the output directory.
+        Write build logs for job C{job} to the output directory, and note
+        how long each trove took to build.
         """
         jobDir = os.path.join('output', 'logs', str(job.jobId))
         client = self._helper.getrMakeClient()
         for trv in job.iterTroves():
+            start = getattr(trv, 'start', None)
+            finish = getattr(trv, 'finish', None)
+            if trv.isBuilt() and start and finish:
+                self._durations[trv.getName()] = max(finish - start,
+                        self._durations.get(trv.getName(), 0))
+
             troveName = '%s{%s}' % (trv.getName(), trv.getContext())
             troveDir = os.path.join(jobDir, troveName)
             if not os.path.isdir(troveDir):
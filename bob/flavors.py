@@ -137,6 +137,17 @@ def expand_targets(cfg):
         return ret
 
 
+def get_major_arch(flavor):
+    '''
+    Return the name of the major architecture of a flavor's instruction set,
+    e.g. x86_64 for a biarch x86_64 flavor, or None if it has none.
+    '''
+    for dep_group in flavor.getDepClasses().itervalues():
+        if isinstance(dep_group, deps.InstructionSetDependency):
+            return arch.getMajorArch(dep_group.getDeps()).name
+    return None
+
+
 def guess_search_flavors(flavor, distro='rPL 1'):
     '''
     Given a build flavor, decide a reasonable search flavor list, possibly
@@ -144,12 +155,7 @@ def guess_search_flavors(flavor, distro='rPL 1'):
     '''
 
     # Determine the major architecture of the given build flavor
-    maj_arch = None
-    for dep_group in flavor.getDepClasses().itervalues():
-        if isinstance(dep_group, deps.InstructionSetDependency):
-            maj_arch = arch.getMajorArch(dep_group.getDeps()).name
-    if not maj_arch:
-        maj_arch = 'x86'
+    maj_arch = get_major_arch(flavor) or 'x86'
 
     distro = _DISTROS[distro]
     arch_set = distro['arches'][maj_arch]
@@ -21,6 +21,8 @@ import optparse
 import os
 import shutil
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
 from conary.build.macros import MacroKeyError
 from conary.lib import util as cny_util
@@ -28,7 +30,9 @@ from rmake import plugins
 from rmake.cmdline import buildcmd
 from rmake.build import buildcfg
 
+from bob import cache
 from bob import config
+from bob import cook
 from bob import coverage
 from bob import flavors
 from bob import recurse
@@ -43,13 +47,16 @@ from bob.scm import hg
 from bob.scm import wms
 from bob.test import TestSuite
 from bob.trove import BobPackage
-from bob.util import ClientHelper, pushStopHandler, reportCommitMap
+from bob.util import ClientHelper, pushStopHandler, popStopHandler
+from bob.util import partial, reportCommitMap
 
 log = logging.getLogger('bob.main')
 
 
 class BobMain(object):
     bobCache = '__bob__'
+    # Seconds between checks of running jobs when pipelining batches
+    pollInterval = 5
 
     def __init__(self, pluginmgr):
         pluginmgr.callClientHook('client_preInit', self, sys.argv)
@@ -62,6 +69,8 @@ class BobMain(object):
         self._targetConfigs = {}
         self._macros = {}
         self._wmsToken = None
+        self._history = None
+        self._parents = {}
 
         # repo info
         self._scm = {}
@@ -92,11 +101,19 @@ class BobMain(object):
         '''
 
         targetPackages = []
-        batch = shadow.ShadowBatch(self._helper)
+        if self._cfg.recipeMetadataCacheSize > 0:
+            metadataCache = cache.DiskCache(
+                    os.path.join(self._helper.cfg.lookaside, self.bobCache,
+                        'recipe-metadata'),
+                    self._cfg.recipeMetadataCacheSize * 1024 * 1024)
+        else:
+            metadataCache = None
+        batch = shadow.ShadowBatch(self._helper, metadataCache=metadataCache)
         mangleData = {  'scm': self._scm,
                         'macros': self._macros,
                         'plan': self._cfg,
                         }
+        targets = []
         for name in self._cfg.target:
             packageName = name.split(':')[0] % self._macros
             sourceName = packageName + ':source'
@@ -118,8 +135,22 @@ class BobMain(object):
                 os.symlink(self.bobCache, cacheDir)
                 if toDelete:
                     cny_util.rmtree(toDelete)
-            recipeFiles = repo.getRecipe(subpath)
-
+            targets.append((sourceName, targetConfig, repo, subpath))
+
+        # One checkout per repository, run concurrently
+        subpathsByRepo = {}
+        for _, _, repo, subpath in targets:
+            subpathsByRepo.setdefault(repo, set()).add(subpath)
+        repos = list(subpathsByRepo)
+        repoRecipes = dict(zip(repos, util.parallelMap(
+            lambda x: x.getRecipes(subpathsByRepo[x]), repos,
+            self._cfg.scmWorkers)))
+        # Each package gets its own copy since mangling modifies it in place
+        allRecipeFiles = [dict(repoRecipes[repo][subpath])
+                for _, _, repo, subpath in targets]
+
+        for (sourceName, targetConfig, _, _), recipeFiles in zip(
+                targets, allRecipeFiles):
             package = BobPackage(sourceName, targetConfig, recipeFiles)
             package.setMangleData(mangleData)
             package.addFlavors(flavors.expand_targets(targetConfig))
@@ -203,9 +234,17 @@ class BobMain(object):
 
         cacheDir = os.path.join(self._helper.cfg.lookaside, self.bobCache)
         cny_util.mkdirChain(cacheDir)
+        if self._cfg.recipeCacheSize > 0:
+            recipeCache = cache.DiskCache(
+                    os.path.join(cacheDir, 'recipe-cache'),
+                    self._cfg.recipeCacheSize * 1024 * 1024)
+        else:
+            recipeCache = None
+        shallowScm = set(x % self._macros for x in self._cfg.shallowScm)
         self._scm = {}
-        for name, (kind, uri, rev) in self._cfg.getRepositories(
-                self._macros).iteritems():
+        toRefresh = []
+        for name, (kind, uri, rev) in sorted(self._cfg.getRepositories(
+                self._macros).iteritems()):
             path = None
             if kind == 'hg':
                 repo = hg.HgRepository(cacheDir, uri)
@@ -215,6 +254,7 @@ class BobMain(object):
                 else:
                     path, branch = uri, 'master'
                 repo = git.GitRepository(cacheDir, path, branch)
+                repo.shallow = name in shallowScm
             elif kind == 'wms':
                 if not rev:
                     raise RuntimeError("SCM statements of type 'wms' require "
@@ -226,6 +266,11 @@ class BobMain(object):
             else:
                 raise TypeError("Invalid SCM type %r in target %r"
                         % (kind, name))
+            repo.recipeCache = recipeCache
+            repo.fetchInterval = self._cfg.scmFetchInterval
+            if kind == 'wms':
+                repo.downloadDir = os.path.join(cacheDir, 'downloads')
+            needTip = False
             if rev:
                 repo.revision = rev
             elif rf.filename:
@@ -248,8 +293,31 @@ class BobMain(object):
                 if not self._cfg.depMode:
                     log.warning('No explicit revision given for repository %s, '
                             'using latest', uri)
-                repo.setFromTip()
-            repo.updateCache()
+                needTip = True
+            toRefresh.append((name, uri, repo, needTip))
+
+        # Look up the tips of all WMS repositories in one go rather than one
+        # round trip per repository.
+        wms.prefetchTips([tipRepo for _, _, tipRepo, wantTip in toRefresh
+            if wantTip and isinstance(tipRepo, wms.WmsRepository)])
+
+        # Repositories that share a cache directory are refreshed one after
+        # another by the same worker, so that no two threads fetch into it at
+        # once (see LockFile).
+        groups = {}
+        for item in toRefresh:
+            key = getattr(item[2], 'repoDir', item[0])
+            groups.setdefault(key, []).append(item)
+
+        def refresh(items):
+            for name, uri, repo, needTip in items:
+                if needTip:
+                    repo.setFromTip()
+                repo.updateCache()
+        util.parallelMap(refresh, [groups[x] for x in sorted(groups)],
+                self._cfg.scmWorkers)
+
+        for name, uri, repo, _ in toRefresh:
             self._scm[name] = repo
             if not self._cfg.depMode:
                 log.info("For repository %s, using %s revision %s", name, uri,
@@ -314,32 +382,44 @@ class BobMain(object):
 
         # Translate configuration into BobPackage objects
         targetPackages = self.loadTargets()
+        for package in targetPackages:
+            for child in package.getChildren():
+                self._parents.setdefault(child, []).append(package)
+
+        # Use past build times to start the longest chains of builds first
+        self._history = cache.BuildHistory(os.path.join(
+            self._helper.cfg.lookaside, self.bobCache, 'build-history.json'))
+        durations = self._history.load()
+        if durations:
+            paths = recurse.getCriticalPaths(targetPackages, durations)
+            estimate = max(paths.values() or [0])
+            log.info('Estimated to finish at %s (%d minutes)',
+                    time.strftime('%H:%M', time.localtime(
+                        time.time() + estimate)), estimate // 60)
 
         # Run and commit each batch
         commitMap = {}
-        for batch in recurse.getBatchFromPackages(self._helper, targetPackages):
-            try:
-                newTroves = batch.run(self)
-            except JobFailedError, e:
-                print 'Job %d failed:' % e.jobId
-                print e.why
-                self._cleanup()
-                return 2
-            except TestFailureError:
-                self._testSuite.merge(batch.getTestSuite())
-                coverage.merge(self._coverageData, batch.getCoverageData())
-
-                # We need to write out the test results early since
-                # some failed
-                self._writeArtifacts()
-                print 'Aborting due to failed tests'
-                self._cleanup()
-                return 0
+        try:
+            if self._cfg.pipelineBatches > 1:
+                self._runPipelined(targetPackages, commitMap, durations)
             else:
-                self._testSuite.merge(batch.getTestSuite())
-                coverage.merge(self._coverageData, batch.getCoverageData())
-                util.insertResolveTroves(self._helper.cfg, newTroves)
-                commitMap.update(newTroves)
+                for batch in recurse.getBatchFromPackages(self._helper,
+                        targetPackages, durations):
+                    newTroves = self._checkBatch(batch,
+                            lambda: batch.run(self))
+                    self._addCommitted(newTroves, commitMap)
+        except JobFailedError, e:
+            print 'Job %d failed:' % e.jobId
+            print e.why
+            self._cleanup()
+            return 2
+        except TestFailureError:
+            # We need to write out the test results early since
+            # some failed
+            self._writeArtifacts()
+            print 'Aborting due to failed tests'
+            self._cleanup()
+            return 0
 
         self._cleanup()
 
@@ -351,6 +431,98 @@ class BobMain(object):
 
         return 0
 
+    def _checkBatch(self, batch, run):
+        '''
+        Call I{run} to finish I{batch} and gather its test results, even if
+        some tests failed. Returns the result of I{run}.
+        '''
+        try:
+            return run()
+        finally:
+            self._history.record(batch.getDurations())
+            if batch.getTestSuite() is not None:
+                self._testSuite.merge(batch.getTestSuite())
+                coverage.merge(self._coverageData, batch.getCoverageData())
+
+    def _addCommitted(self, newTroves, commitMap):
+        '''
+        Make troves committed by a batch available to later batches.
+        '''
+        util.insertResolveTroves(self._helper.cfg, newTroves)
+        # Existing builds of all batches share the job ID None
+        for jobId, troves in newTroves.iteritems():
+            commitMap.setdefault(jobId, {}).update(troves)
+            if jobId is None:
+                continue
+            # Existing builds of groups including anything that was just
+            # built are out of date
+            for sourceTup in troves:
+                for parent in self._parents.get(sourceTup[0], ()):
+                    parent.childrenRebuilt = True
+
+    def _runPipelined(self, targetPackages, commitMap, durations):
+        '''
+        Build and commit batches as soon as the packages they include have
+        been committed, with up to C{pipelineBatches} rMake jobs running at
+        once.
+
+        With C{asyncCommit}, finished jobs are committed in the background
+        while other jobs keep building, and only the batches that include
+        their troves wait for the commit.
+        '''
+        scheduler = recurse.PipelineScheduler(self._helper, targetPackages,
+                durations)
+        queued = []
+        running = []
+        committing = {}
+        if self._cfg.showBuildLogs:
+            log.warning("showBuildLogs is ignored when pipelineBatches is "
+                    "set; only job state changes are reported")
+        pool = None
+        if self._cfg.asyncCommit:
+            pool = ThreadPool(self._cfg.pipelineBatches)
+        pushStopHandler(partial(cook.stopJobs, running))
+        try:
+            while not scheduler.isFinished():
+                queued.extend(scheduler.getReady())
+                queued.sort(key=scheduler.getPriority, reverse=True)
+                while queued and len(running) < self._cfg.pipelineBatches:
+                    batch = queued.pop(0)
+                    batch.start(self)
+                    running.append(batch)
+
+                done = [x for x in running if x.poll()]
+                committed = [x for x, result in committing.items()
+                        if result.ready()]
+                if not done and not committed:
+                    time.sleep(self.pollInterval)
+                    continue
+                for batch in done:
+                    running.remove(batch)
+                    if pool:
+                        self._checkBatch(batch, batch.check)
+                        committing[batch] = pool.apply_async(batch.commit,
+                                (self._helper.clone(),))
+                        continue
+                    newTroves = self._checkBatch(batch, batch.finish)
+                    self._addCommitted(newTroves, commitMap)
+                    scheduler.markDone(batch)
+                for batch in committed:
+                    newTroves = committing.pop(batch).get()
+                    self._addCommitted(newTroves, commitMap)
+                    scheduler.markDone(batch)
+        except:
+            # Don't leave the other jobs building
+            for batch in running:
+                batch.stop()
+            raise
+        finally:
+            popStopHandler()
+            if pool:
+                # Never abandon a commit half way
+                pool.close()
+                pool.join()
+
     def runDeps(self):
         self._cfg.depMode = True
         self._configure()
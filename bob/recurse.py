@@ -20,7 +20,6 @@ Tools for recursing through a set of targets, and for preparing batches
 to build.
 '''
 
-import copy
 import logging
 
 from bob.cook import Batch
@@ -30,7 +29,7 @@ from bob.errors import DependencyLoopError
 log = logging.getLogger('bob.recurse')
 
 
-def getBatchFromPackages(helper, packageList):
+def getBatchFromPackages(helper, packageList, durations=None):
     '''
     Given a set of I{BobPackage}s, yield a sequence of I{Batch} objects
     to build and commit.
@@ -49,12 +48,17 @@ def getBatchFromPackages(helper, packageList):
     batch will contain a single flavor from each of the serialized
     packages, rather than running one batch per flavor per package.
 
+    Within a batch, the packages on the longest critical path according
+    to I{durations} are submitted first.
+
     @param helper: ClientHelper object
     @param packageList: List of I{BobPackage}s to build
+    @param durations: Dictionary of build times by source name
     '''
 
     built = set() # names
     notBuilt = set(packageList) # BobPackages
+    paths = getCriticalPaths(packageList, durations or {})
 
     while notBuilt:
         # Determine which troves can be built
@@ -78,31 +82,209 @@ def getBatchFromPackages(helper, packageList):
         notBuilt -= thisRound
         built |= set(x.getName() for x in thisRound)
 
-        # Create a batch and add all non-serialized packages, saving
-        # the serialized ones for later.
-        toSerialize = []
-        batch = Batch(helper)
-        for bobTrove in thisRound:
-            if bobTrove.getTargetConfig().serializeFlavors:
-                toSerialize.append(bobTrove)
-            else:
-                batch.addTrove(bobTrove)
-
         # Immediately yield the set of buildable packages that do not
-        # need to be serialized.
-        if not batch.isEmpty():
+        # need to be serialized, then the serialized ones.
+        batch, chains = _makeBatches(helper, _byPriority(thisRound, paths))
+        if batch.hasWork():
             yield batch
+        for serialBatches, _ in chains:
+            for batch in serialBatches:
+                if batch.hasWork():
+                    yield batch
+
+
+def getCriticalPaths(packageList, durations):
+    '''
+    Return a dictionary mapping the name of each of I{packageList} to the
+    time in seconds expected from starting to build it until every group
+    that includes it, directly or not, is built. The build time of each
+    package is taken from I{durations}; packages without one are assumed to
+    take the average time.
+
+    @param packageList: List of I{BobPackage}s to build
+    @param durations: Dictionary of build times by source name
+    '''
+    known = [durations[x.getName()] for x in packageList
+            if x.getName() in durations]
+    default = known and sum(known) / len(known) or 0
+    parents = {}
+    for package in packageList:
+        for child in package.getChildren():
+            parents.setdefault(child, []).append(package.getName())
+
+    paths = {}
+    def getPath(name, visiting):
+        if name in paths:
+            return paths[name]
+        if name in visiting:
+            # Dependency loops are reported when scheduling
+            return 0
+        visiting.add(name)
+        after = [getPath(x, visiting) for x in parents.get(name, ())]
+        visiting.discard(name)
+        paths[name] = durations.get(name, default) + max(after or [0])
+        return paths[name]
+
+    for package in packageList:
+        getPath(package.getName(), set())
+    return paths
+
+
+def _byPriority(packages, paths):
+    '''
+    Sort I{packages} with the longest critical path first.
+    '''
+    return sorted(packages, key=lambda x: (-paths.get(x.getName(), 0),
+        x.getName()))
+
+
+def _makeBatches(helper, packages, chainPerPackage=False):
+    '''
+    Put I{packages} into batches. Returns a batch with all the
+    non-serialized packages, and a list of chains of batches with the
+    serialized ones, one batch per flavor. The batches of a chain must be
+    built one after another. Each chain is a tuple of its batches and the
+    packages in them.
+
+    Normally there is one chain whose batches each hold one flavor of every
+    serialized package. With I{chainPerPackage} each serialized package
+    gets a chain of its own, so that the flavors of different packages do
+    not wait for each other.
+    '''
+
+    # Create a batch and add all non-serialized packages, saving
+    # the serialized ones for later.
+    toSerialize = []
+    batch = Batch(helper)
+    for bobTrove in packages:
+        if bobTrove.getTargetConfig().serializeFlavors:
+            toSerialize.append(bobTrove)
+        else:
+            batch.addTrove(bobTrove)
+
+    # Now go back to the serialized ones, splitting them by flavor
+    # into individual packages.
+    chains = {}
+    for bobTrove in toSerialize:
+        key = chainPerPackage and bobTrove.getName() or None
+        batches, members = chains.setdefault(key, ([], set()))
+        members.add(bobTrove)
+        for idx, flavor in enumerate(sorted(bobTrove.getFlavors())):
+            if len(batches) == idx:
+                batches.append(Batch(helper))
+            batches[idx].addTrove(bobTrove.getFlavorView(flavor))
+    return batch, [chains[x] for x in sorted(chains)]
 
-        # Now go back to the serialized ones, splitting them by flavor
-        # into individual packages.
-        batches = []
-        for bobTrove in toSerialize:
-            for idx, flavor in enumerate(sorted(bobTrove.getFlavors())):
-                newTrove = copy.deepcopy(bobTrove)
-                newTrove.setFlavors([flavor])
-                newTrove.getTargetConfig().flavor = [str(flavor)]
-                if len(batches) == idx:
-                    batches.append(Batch(helper))
-                batches[idx].addTrove(newTrove)
+
+class PipelineScheduler(object):
+    '''
+    Hand out batches of I{BobPackage}s to build as soon as the packages
+    included in them have been built, instead of one level of group
+    inclusion at a time like L{getBatchFromPackages}. The caller starts
+    the batches returned by L{getReady} and calls L{markDone} as each one
+    is committed.
+
+    Packages that become buildable together go into the same batch, except
+    that each group is built in a batch of its own. Each serialized package
+    is split by flavor into a chain of batches that are handed out one
+    after another, while the chains of different packages run alongside
+    each other.
+
+    Batches are handed out with the longest critical path according to
+    I{durations} first.
+
+    @param helper: ClientHelper object
+    @param packageList: List of I{BobPackage}s to build
+    @param durations: Dictionary of build times by source name
+    '''
+
+    def __init__(self, helper, packageList, durations=None):
+        self._helper = helper
+        self._paths = getCriticalPaths(packageList, durations or {})
+        self._priority = {}
+        self._notStarted = set(packageList)
+        self._built = set() # names
+        # Batches that can be started, and the rest of the chain and the
+        # packages of each batch that is queued or running
+        self._queued = []
+        self._chains = {}
+
+    def isFinished(self):
+        '''
+        Returns C{True} once every package has been built.
+        '''
+        return not (self._notStarted or self._chains)
+
+    def getReady(self):
+        '''
+        Return a list of batches that can be started now.
+        '''
+        while True:
+            thisRound = set(x for x in self._notStarted
+                    if x.getChildren() <= self._built)
+            if not thisRound:
+                break
+            self._notStarted -= thisRound
+
+            # Packages that are ready at the same time are built together,
+            # but each group gets its own batch so that the groups that
+            # include it can start as soon as it is done.
+            groups = [x for x in thisRound
+                    if x.getPackageName().startswith('group-')]
+            rounds = [thisRound - set(groups)] + [set([x]) for x in groups]
+            for packages in rounds:
+                batch, chains = _makeBatches(self._helper,
+                        _byPriority(packages, self._paths),
+                        chainPerPackage=True)
+                nonSerial = set(x for x in packages
+                        if not x.getTargetConfig().serializeFlavors)
+                self._addChain([batch], nonSerial)
+                for serialBatches, members in chains:
+                    self._addChain(serialBatches, members)
+
+        if self._notStarted and not self._chains:
+            # Nothing can be built!
+            log.error('Unmet dependencies:')
+            for bobPackage in self._notStarted:
+                log.error('  %s: %s', bobPackage.getName(),
+                        ' '.join(bobPackage.getChildren() - self._built))
+            raise DependencyLoopError()
+
+        ready, self._queued = self._queued, []
+        ready.sort(key=self.getPriority, reverse=True)
+        return ready
+
+    def getPriority(self, batch):
+        '''
+        Return the length in seconds of the longest critical path through
+        the packages of I{batch}.
+        '''
+        return self._priority.get(batch, 0)
+
+    def _addChain(self, batches, packages):
+        '''
+        Queue the first of I{batches}, or mark I{packages} built at once if
+        there is nothing to build.
+        '''
+        batches = [x for x in batches if x.hasWork()]
+        if not batches:
+            self._built |= set(x.getName() for x in packages)
+            return
+        priority = max([self._paths.get(x.getName(), 0) for x in packages]
+                or [0])
         for batch in batches:
-            yield batch
+            self._priority[batch] = priority
+        self._queued.append(batches[0])
+        self._chains[batches[0]] = (batches[1:], packages)
+
+    def markDone(self, batch):
+        '''
+        Record that I{batch} has been built and committed.
+        '''
+        chain, packages = self._chains.pop(batch)
+        self._priority.pop(batch, None)
+        if chain:
+            self._queued.append(chain[0])
+            self._chains[chain[0]] = (chain[1:], packages)
+        else:
+            self._built |= set(x.getName() for x in packages)
@@ -15,19 +15,26 @@
 #
 
 import os
-import tempfile
-from conary.lib import util
+import posixpath
+import tarfile
+import time
 
 
 class ScmRepository(object):
 
     revision = None
     revIsExact = False
+    recipeCache = None
+    fetchInterval = 0
 
     def isLocal(self):
         """Returns True if the repository is on the local filesystem"""
         return False
 
+    def getURI(self):
+        """Return a string identifying this repository"""
+        return self.uri
+
     def getTip(self):
         """Return the latest commit ID for this repository"""
         raise NotImplementedError
@@ -36,37 +43,73 @@ class ScmRepository(object):
         """Refresh the local cache for the repository"""
         raise NotImplementedError
 
+    def _fetchedRecently(self, stampPath):
+        """
+        Returns True if the cache was refreshed less than C{fetchInterval}
+        seconds ago, according to the mtime of C{stampPath}.
+        """
+        if not self.fetchInterval:
+            return False
+        try:
+            mtime = os.stat(stampPath).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime < self.fetchInterval
+
+    def _markFetched(self, stampPath):
+        open(stampPath, 'w').close()
+
     def getRecipe(self, subpath):
         """Return a dictionary of file contents at the given subpath"""
+        return self.getRecipes([subpath])[subpath]
+
+    def getRecipes(self, subpaths):
+        """
+        Return a dictionary mapping each of the given subpaths to a dictionary
+        of the file contents at that subpath, using a single checkout.
+        """
         assert self.revision
-        # Update the local repository cache.
-        workDir = tempfile.mkdtemp()
-        try:
-            prefix = self.checkout(workDir, subpath) or ''
-            # Read in all the files for the requested subpath
-            subDir = os.path.join(workDir, prefix, subpath)
-            if not os.path.isdir(subDir):
-                raise RuntimeError(
-                        "sourceTree %s does not exist or is not a directory" %
-                        subpath)
-            files = {}
-            for name in os.listdir(subDir):
-                filePath = os.path.realpath(os.path.join(subDir, name))
-                if not filePath.startswith(workDir):
-                    raise RuntimeError(
-                            "Illegal symlink %s points outside checkout: %s"
-                            % (os.path.join(subpath, name), filePath))
-                with open(filePath, 'rb') as fobj:
-                    files[name] = fobj.read()
-            return files
-        finally:
-            util.rmtree(workDir)
+        subpaths = sorted(set(subpaths))
+        # Recipes at an exact revision never change, so they can be served
+        # from the persistent cache.
+        useCache = self.recipeCache is not None and self.revIsExact
+        recipes = {}
+        if useCache:
+            for subpath in subpaths:
+                files = self.recipeCache.get(self._recipeCacheKey(subpath))
+                if files is not None:
+                    recipes[subpath] = files
+        missing = [x for x in subpaths if x not in recipes]
+        if missing:
+            fetched = self.readArchive(missing)
+            if useCache:
+                for subpath, files in fetched.iteritems():
+                    self.recipeCache.put(self._recipeCacheKey(subpath), files)
+            recipes.update(fetched)
+        return recipes
+
+    def _recipeCacheKey(self, subpath):
+        return repr((self.getURI(), self.revision, subpath))
+
+    def readArchive(self, subtrees):
+        """
+        Stream an archive of C{subtrees} at the current revision and return
+        the result of L{readRecipes} on it.
+        """
+        raise NotImplementedError
 
     def getAction(self, extra=''):
         """Return a Conary source action to unpack this repository"""
         raise NotImplementedError
 
-    def fetchArchive(self, conarySource, snapPath):
+    def fetchArchive(self, conarySource, snapPath, verify=None):
+        """
+        Download a snapshot archive of the repository to C{snapPath}. If
+        C{verify} is given, it is called with the path of the downloaded file
+        and must return True if the file is intact. If it also has a
+        C{getValidator} method, implementations may use the validator it
+        returns to check the data as it arrives instead.
+        """
         raise NotImplementedError
 
     def setFromTip(self):
@@ -82,3 +125,119 @@ class ScmRepository(object):
             return self.revision[:12]
         else:
             return self.revision
+
+
+def readRecipes(fobj, subpaths, prefix=''):
+    """
+    Read a tar stream from C{fobj} and return a dictionary mapping each of
+    C{subpaths} to a dictionary of the files directly inside it. Nothing is
+    written to disk. Member names are taken relative to C{prefix}, and any
+    member or symlink that would resolve outside of the archive is rejected.
+    """
+    prefix = prefix and posixpath.normpath(prefix)
+    files = {}
+    links = {}
+    dirs = set([''])
+    tar = tarfile.open(fileobj=fobj, mode='r|')
+    for member in tar:
+        path = _memberPath(member.name, prefix)
+        if path is None:
+            continue
+        if member.isdir():
+            dirs.add(path)
+        elif member.issym():
+            links[path] = member.linkname
+        elif member.islnk():
+            target = _memberPath(member.linkname, prefix)
+            if target not in files:
+                raise RuntimeError("Hard link %s points to missing file %s"
+                        % (path, member.linkname))
+            files[path] = files[target]
+        elif member.isfile():
+            files[path] = tar.extractfile(member).read()
+    tar.close()
+    for path in files.keys() + links.keys():
+        while path:
+            path = posixpath.dirname(path)
+            dirs.add(path)
+
+    recipes = {}
+    for subpath in subpaths:
+        subDir = posixpath.normpath(subpath).strip('/')
+        if subDir == '.':
+            subDir = ''
+        if subDir not in dirs:
+            raise RuntimeError(
+                    "sourceTree %s does not exist or is not a directory" %
+                    subpath)
+        contents = {}
+        for path in sorted(files.keys() + links.keys()):
+            if posixpath.dirname(path) != subDir:
+                continue
+            name = posixpath.basename(path)
+            realPath = _resolvePath(path, links)
+            if realPath is None:
+                raise RuntimeError(
+                        "Illegal symlink %s points outside checkout: %s"
+                        % (posixpath.join(subpath, name), links.get(path)))
+            if realPath not in files:
+                raise RuntimeError("Symlink %s points to %s, which is not "
+                        "a file in the checkout" % (
+                            posixpath.join(subpath, name), realPath))
+            contents[name] = files[realPath]
+        for path in dirs:
+            if path and posixpath.dirname(path) == subDir:
+                raise RuntimeError("sourceTree %s contains a subdirectory %s"
+                        % (subpath, posixpath.basename(path)))
+        recipes[subpath] = contents
+    return recipes
+
+
+def _memberPath(name, prefix):
+    """
+    Normalize archive member C{name} relative to C{prefix}. Returns C{None}
+    for members outside of the prefix.
+    """
+    path = posixpath.normpath(name)
+    if path.startswith('/') or path == '..' or path.startswith('../'):
+        raise RuntimeError("Illegal path %s in archive" % (name,))
+    if path == '.':
+        path = ''
+    if prefix:
+        if path == prefix:
+            return ''
+        if not path.startswith(prefix + '/'):
+            return None
+        path = path[len(prefix) + 1:]
+    return path
+
+
+def _resolvePath(path, links):
+    """
+    Resolve all symlinks in the archive path C{path}, like C{realpath}. Returns
+    C{None} if the result would lie outside of the archive.
+    """
+    parts = path.split('/')
+    resolved = []
+    hops = 0
+    while parts:
+        part = parts.pop(0)
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if not resolved:
+                return None
+            resolved.pop()
+            continue
+        resolved.append(part)
+        target = links.get('/'.join(resolved))
+        if target is None:
+            continue
+        hops += 1
+        if hops > 40:
+            raise RuntimeError("Too many levels of symlinks at %s" % (path,))
+        if target.startswith('/'):
+            return None
+        resolved.pop()
+        parts = target.split('/') + parts
+    return '/'.join(resolved)
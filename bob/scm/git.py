@@ -21,7 +21,10 @@ Helper functions for dealing with git repositories.
 
 import logging
 import os
+import signal
 import subprocess
+import sys
+import tempfile
 
 from bob import scm
 from bob.util import LockFile
@@ -31,6 +34,8 @@ log = logging.getLogger('bob.scm')
 
 class GitRepository(scm.ScmRepository):
 
+    shallow = False
+
     def __init__(self, cacheDir, uri, branch):
         self.uri = uri
         self.branch = branch
@@ -53,30 +58,99 @@ class GitRepository(scm.ScmRepository):
         assert len(rev) == 40
         return rev
 
+    def _hasRevision(self):
+        """Returns True if the exact revision is already in the cache"""
+        if not (self.revIsExact and self.revision):
+            return False
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['git', 'cat-file', '-e',
+                self.revision + '^{commit}'], cwd=self.repoDir,
+                stdout=devnull, stderr=devnull) == 0
+
     def updateCache(self):
         # Create the cache repo if needed.
         if not os.path.isdir(self.repoDir):
             os.makedirs(self.repoDir)
+        stampPath = os.path.join(self.repoDir,
+                'fetch_stamp_' + self.branch.replace('/', '_'))
         with LockFile(self.repoDir + '/fetch_lock'):
             if not (os.path.isdir(self.repoDir + '/refs')
                     or os.path.isdir(self.repoDir + '/.git/refs')):
                 subprocess.check_call(['git', 'init', '-q', '--bare'],
                         cwd=self.repoDir)
-            subprocess.check_call(['git', 'fetch', '-q', '-f',
-                self.uri, '+%s:%s' % (self.branch, self.branch)],
-                cwd=self.repoDir)
-
-    def checkout(self, workDir, subtree):
-        p1 = subprocess.Popen(['git', 'archive', '--format=tar',
-            self.revision, subtree], stdout=subprocess.PIPE, cwd=self.repoDir)
-        p2 = subprocess.Popen(['tar', '-x'], stdin=p1.stdout, cwd=workDir)
-        p1.stdout.close()  # remove ourselves from between git and tar
-        p1.wait()
-        p2.wait()
-        if p1.returncode:
-            raise RuntimeError("git exited with status %s" % p1.returncode)
-        if p2.returncode:
-            raise RuntimeError("tar exited with status %s" % p1.returncode)
+            if self.revIsExact:
+                if self._hasRevision():
+                    log.debug("Revision %s of %s is already cached",
+                            self.getShortRev(), self.uri)
+                    return
+            elif self._fetchedRecently(stampPath):
+                log.debug("Branch %s of %s was fetched recently",
+                        self.branch, self.uri)
+                return
+            if not (self.shallow and self._fetchShallow()):
+                args = ['git', 'fetch', '-q', '-f']
+                if os.path.exists(os.path.join(self.repoDir, 'shallow')):
+                    # Left behind by a shallow fetch; get the full history.
+                    args.append('--unshallow')
+                subprocess.check_call(args + [self.uri,
+                    '+%s:%s' % (self.branch, self.branch)], cwd=self.repoDir)
+            self._markFetched(stampPath)
+
+    def _fetchShallow(self):
+        """
+        Fetch only the needed commit, without history. Returns False if the
+        pinned revision could not be obtained this way, in which case a full
+        fetch is needed.
+        """
+        refspecs = ['+%s:%s' % (self.branch, self.branch)]
+        if self.revIsExact:
+            # Not all servers allow fetching an arbitrary commit by ID, so
+            # fall back to the branch head in case it is the pinned revision.
+            refspecs.insert(0, self.revision)
+        for refspec in refspecs:
+            with open(os.devnull, 'w') as devnull:
+                status = subprocess.call(['git', 'fetch', '-q', '-f',
+                    '--depth=1', self.uri, refspec], cwd=self.repoDir,
+                    stderr=devnull)
+            if status:
+                log.debug("Shallow fetch of %s from %s failed with status %s",
+                        refspec, self.uri, status)
+                continue
+            if not self.revIsExact or self._hasRevision():
+                return True
+        log.info("Revision %s is not reachable with a shallow fetch of %s; "
+                "fetching full history", self.getShortRev(), self.uri)
+        return False
+
+    def readArchive(self, subtrees):
+        stderr = tempfile.TemporaryFile()
+        try:
+            p1 = subprocess.Popen(['git', 'archive', '--format=tar',
+                self.revision] + list(subtrees), stdout=subprocess.PIPE,
+                stderr=stderr, cwd=self.repoDir)
+            try:
+                recipes = scm.readRecipes(p1.stdout, subtrees)
+            except:
+                # Closing the pipe stops git with SIGPIPE if it is still
+                # writing, which is not the error to report. Anything else
+                # means git failed first, e.g. on a bad path or revision.
+                excInfo = sys.exc_info()
+                p1.stdout.close()
+                if p1.wait() not in (0, -signal.SIGPIPE):
+                    self._archiveFailed(p1.returncode, stderr)
+                raise excInfo[0], excInfo[1], excInfo[2]
+            p1.stdout.close()
+            if p1.wait():
+                self._archiveFailed(p1.returncode, stderr)
+            return recipes
+        finally:
+            stderr.close()
+
+    def _archiveFailed(self, returncode, stderr):
+        stderr.seek(0)
+        raise RuntimeError("git archive of %s at %s exited with status %s: %s"
+                % (self.uri, self.revision, returncode,
+                    stderr.read().strip()))
 
     def getAction(self, extra=''):
         return 'addGitSnapshot(%r, branch=%r, tag=%r%s)' % (
@@ -19,12 +19,13 @@
 Helper functions for dealing with mercurial (hg) repositories.
 '''
 
+import atexit
 import logging
 import os
+import struct
 import subprocess
-
-from mercurial import hg, ui
-from mercurial.node import short
+import threading
+from StringIO import StringIO
 
 from bob import scm
 
@@ -43,27 +44,180 @@ class HgRepository(scm.ScmRepository):
     def isLocal(self):
         return self.uri.startswith('/') or self.uri.startswith('file:')
 
-    def getTip(self):
-        hg_ui = ui.ui()
-        if hasattr(hg, 'peer'):
-            repo = hg.peer(hg_ui, {}, self.uri)
-        else:
-            repo = hg.repository(hg_ui, self.uri)
-        return short(repo.heads()[0])
-
-    def updateCache(self):
+    def _initCache(self):
         # Create the cache repo if needed.
         if not os.path.isdir(self.repoDir):
             os.makedirs(self.repoDir)
         if not os.path.isdir(self.repoDir + '/.hg'):
             subprocess.check_call(['hg', 'init'], cwd=self.repoDir)
-        subprocess.check_call(['hg', 'pull', '-qf', self.uri], cwd=self.repoDir)
 
-    def checkout(self, workDir, subtree):
-        subprocess.check_call(['hg', 'archive', '--type=files',
-            '--rev', self.revision, '--include', subtree,
-            workDir], cwd=self.repoDir)
+    def _hg(self, args, stdout=None, check=True):
+        '''
+        Run an hg command against the cache repository, through the shared
+        command server when one is available. Output is written to
+        C{stdout}, if given. Returns the exit status.
+        '''
+        self._initCache()
+        server = getCommandServer(self.repoDir)
+        if server:
+            status, errors = server.runcommand(args, stdout)
+        else:
+            proc = subprocess.Popen(['hg'] + args, cwd=self.repoDir,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = proc.communicate()
+            status = proc.returncode
+            if stdout:
+                stdout.write(output)
+        if status and check:
+            raise RuntimeError("hg %s exited with status %s: %s"
+                    % (args[0], status, errors.strip()))
+        return status
+
+    def getTip(self):
+        output = StringIO()
+        self._hg(['identify', '--id', self.uri], stdout=output)
+        return output.getvalue().split()[0]
+
+    def _hasRevision(self):
+        """Returns True if the exact revision is already in the cache"""
+        if not (self.revIsExact and self.revision):
+            return False
+        return self._hg(['log', '-q', '-r', self.revision],
+                stdout=StringIO(), check=False) == 0
+
+    def updateCache(self):
+        self._initCache()
+        stampPath = os.path.join(self.repoDir, '.hg', 'fetch_stamp')
+        if self.revIsExact:
+            if self._hasRevision():
+                log.debug("Revision %s of %s is already cached",
+                        self.getShortRev(), self.uri)
+                return
+        elif self._fetchedRecently(stampPath):
+            log.debug("%s was pulled recently", self.uri)
+            return
+        self._hg(['pull', '-qf', self.uri])
+        self._markFetched(stampPath)
+
+    def readArchive(self, subtrees):
+        args = ['archive', '--type=tar', '--prefix=.', '--rev', self.revision]
+        for subtree in subtrees:
+            args.extend(['--include', subtree])
+        output = StringIO()
+        self._hg(args + ['-'], stdout=output)
+        output.seek(0)
+        return scm.readRecipes(output, subtrees)
 
     def getAction(self, extra=''):
         return 'addMercurialSnapshot(%r, tag=%r%s)' % (self.uri,
                 self.getShortRev(), extra)
+
+
+class HgCommandServer(object):
+    '''
+    A long-lived C{hg serve --cmdserver pipe} process serving one repository,
+    which saves paying the mercurial startup cost for every command.
+    '''
+
+    def __init__(self, repoDir):
+        self.repoDir = repoDir
+        self._lock = threading.Lock()
+        env = dict(os.environ, HGPLAIN='1')
+        self.proc = subprocess.Popen(['hg', 'serve', '--cmdserver', 'pipe',
+            '--config', 'ui.interactive=False'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, cwd=repoDir, env=env, close_fds=True)
+        try:
+            channel, hello = self._readChannel()
+        except:
+            self.close()
+            raise
+        capabilities = ''
+        for line in hello.splitlines():
+            if line.startswith('capabilities:'):
+                capabilities = line.split(':', 1)[1].split()
+        if channel != 'o' or 'runcommand' not in capabilities:
+            self.close()
+            raise RuntimeError("hg command server does not support "
+                    "runcommand")
+
+    def _read(self, size):
+        data = self.proc.stdout.read(size)
+        if len(data) != size:
+            raise RuntimeError("hg command server for %s exited unexpectedly"
+                    % (self.repoDir,))
+        return data
+
+    def _readChannel(self):
+        channel, length = struct.unpack('>cI', self._read(5))
+        if channel in 'IL':
+            # Input requests carry the requested size instead of data
+            return channel, length
+        return channel, self._read(length)
+
+    def runcommand(self, args, stdout=None):
+        '''
+        Run hg with C{args}, writing its output to C{stdout} if given. Returns
+        a tuple C{(status, errors)}.
+        '''
+        data = '\0'.join(args)
+        errors = []
+        with self._lock:
+            self.proc.stdin.write('runcommand\n'
+                    + struct.pack('>I', len(data)) + data)
+            self.proc.stdin.flush()
+            while True:
+                channel, data = self._readChannel()
+                if channel == 'o':
+                    if stdout:
+                        stdout.write(data)
+                elif channel == 'e':
+                    errors.append(data)
+                elif channel == 'r':
+                    return struct.unpack('>i', data)[0], ''.join(errors)
+                elif channel in 'IL':
+                    # Never interactive; answer with EOF
+                    self.proc.stdin.write(struct.pack('>I', 0))
+                    self.proc.stdin.flush()
+                elif channel.isupper():
+                    raise RuntimeError("hg command server requested "
+                            "unsupported channel %r" % (channel,))
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+
+
+_servers = {}
+_serversLock = threading.Lock()
+
+
+def getCommandServer(repoDir):
+    '''
+    Return the command server for C{repoDir}, starting it if needed. Returns
+    C{None} if this version of hg cannot run one.
+    '''
+    key = os.getpid(), repoDir
+    with _serversLock:
+        if key not in _servers:
+            try:
+                _servers[key] = HgCommandServer(repoDir)
+            except (OSError, RuntimeError), err:
+                log.debug("Not using hg command server for %s: %s",
+                        repoDir, err)
+                _servers[key] = None
+        return _servers[key]
+
+
+@atexit.register
+def closeCommandServers():
+    '''
+    Stop all command servers started by this process.
+    '''
+    with _serversLock:
+        for (pid, _), server in _servers.items():
+            if server and pid == os.getpid():
+                server.close()
+        _servers.clear()
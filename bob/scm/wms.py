@@ -15,32 +15,48 @@
 #
 
 import base64
+import hashlib
 import json
 import logging
 import os
+import shutil
 import subprocess
+import threading
 import urllib
 from conary.lib.http import http_error
 from conary.lib.http import opener
 from conary.lib.http.request import URL
-from conary.lib.util import copyfileobj
 
 from bob import scm
+from bob.util import LockFile, parallelMap
 
 log = logging.getLogger('bob.scm')
 
 
 class WmsRepository(scm.ScmRepository):
 
+    # Where partially downloaded archives are kept so that a later run can
+    # resume them. If unset they are kept next to the destination.
+    downloadDir = None
+
     def __init__(self, cfg, path, branch=None):
         self.wms = WmsClient(cfg)
         self.path = path
         self.branch = branch
-        self._open = opener.URLOpener(followRedirects=True).open
+        self._tip = None
+
+    def getURI(self):
+        # The same path can exist on more than one WMS server
+        return str(self.wms.base.join(self.path))
 
     def _getTip(self):
-        for path, branch, tip in self.wms.poll(self.path,
-                self.branch or 'HEAD'):
+        if self._tip is None:
+            self._tip = self._findTip(self.wms.poll(self.path,
+                self.branch or 'HEAD'))
+        return self._tip
+
+    def _findTip(self, results):
+        for path, branch, tip in results:
             if path == self.path:
                 assert len(tip) == 40
                 return branch, tip
@@ -64,9 +80,9 @@ class WmsRepository(scm.ScmRepository):
                 + '-' + self.getShortRev()
                 + '.tar' + compress)
 
-    def checkout(self, workDir, subtree=None):
+    def checkout(self, workDir, subtrees=None):
         name = self._archive()
-        f = self.wms.archive(self.path, self.revision, name, subtree)
+        f = self.wms.archive(self.path, self.revision, name, subtrees)
         tar = subprocess.Popen(['tar', '-x'], stdin=subprocess.PIPE,
                 cwd=workDir)
         while True:
@@ -81,20 +97,105 @@ class WmsRepository(scm.ScmRepository):
         prefix = name.rsplit('.', 1)[0]
         return prefix
 
+    def readArchive(self, subtrees):
+        name = self._archive()
+        f = self.wms.archive(self.path, self.revision, name, subtrees)
+        try:
+            recipes = scm.readRecipes(f, subtrees,
+                    prefix=urllib.unquote(name.rsplit('.', 1)[0]))
+            # Drain the end-of-archive padding so the connection can be reused
+            while f.read(10000):
+                pass
+            return recipes
+        finally:
+            f.close()
+
     def getAction(self, extra=''):
         url = self.wms.show_url(self.path)
         return 'addGitSnapshot(%r, branch=%r, tag=%r%s)' % (
                 url, self.branch, self.getShortRev(), extra)
 
-    def fetchArchive(self, conarySource, snapPath):
+    def fetchArchive(self, conarySource, snapPath, verify=None):
         if os.path.exists(snapPath):
             return
         archive = urllib.quote(os.path.basename(snapPath))
-        log.info("Downloading %s", archive)
-        f_in = self.wms.archive(self.path, self.revision, archive)
-        with open(snapPath, 'w') as f_out:
-            copyfileobj(f_in, f_out)
-        f_in.close()
+        if self.downloadDir:
+            if not os.path.isdir(self.downloadDir):
+                os.makedirs(self.downloadDir)
+            partPath = os.path.join(self.downloadDir, hashlib.sha1(repr(
+                (self.path, self.revision, archive))).hexdigest() + '.part')
+        else:
+            partPath = snapPath + '.part'
+        with _getDownloadLock(partPath), LockFile(partPath + '.lock'):
+            # Another worker may have finished it while we waited
+            if os.path.exists(snapPath):
+                return
+            self._download(archive, partPath, verify)
+            # Never leave a partial file at the final path
+            tmpPath = snapPath + '.tmp'
+            shutil.move(partPath, tmpPath)
+            os.rename(tmpPath, snapPath)
+
+    def _download(self, archive, partPath, verify):
+        while True:
+            offset = 0
+            if os.path.exists(partPath):
+                offset = os.path.getsize(partPath)
+            # Check the archive while it downloads, if possible
+            validator = None
+            if hasattr(verify, 'getValidator'):
+                validator = verify.getValidator()
+            if offset:
+                log.info("Resuming download of %s at %d bytes", archive,
+                        offset)
+                headers = [('Range', 'bytes=%d-' % offset)]
+            else:
+                log.info("Downloading %s", archive)
+                headers = []
+            try:
+                f_in = self.wms.archive(self.path, self.revision, archive,
+                        headers=headers)
+            except http_error.ResponseError as err:
+                if not offset:
+                    raise
+                if err.errcode != 416:
+                    log.warning("Resuming download of %s failed with HTTP "
+                            "status %s; downloading it again", archive,
+                            err.errcode)
+                    os.unlink(partPath)
+                    continue
+                # The partial file is already complete, so check all of it
+                validator = None
+            else:
+                if offset and _getRangeStart(f_in) != offset:
+                    f_in.close()
+                    log.warning("Server did not resume %s at byte %d; "
+                            "downloading it again", archive, offset)
+                    os.unlink(partPath)
+                    continue
+                try:
+                    if offset and validator:
+                        with open(partPath, 'rb') as f_part:
+                            _copyChunks(f_part, None, validator)
+                    with open(partPath, offset and 'ab' or 'wb') as f_out:
+                        _copyChunks(f_in, f_out, validator)
+                finally:
+                    f_in.close()
+            if validator:
+                valid = validator.finish()
+            elif verify:
+                valid = verify(partPath)
+            else:
+                valid = True
+            if not valid:
+                os.unlink(partPath)
+                if offset:
+                    log.warning("Resumed download of %s is corrupt; "
+                            "downloading it again", archive)
+                    continue
+                raise RuntimeError("Downloaded archive %s is corrupt"
+                        % (archive,))
+            return
 
     def setRevision(self, rev):
         super(WmsRepository, self).setRevision(rev)
@@ -104,6 +205,71 @@ class WmsRepository(scm.ScmRepository):
             self.path = rev['path']
 
 
+_downloadLocks = {}
+_downloadLocksLock = threading.Lock()
+
+
+def _getDownloadLock(path):
+    """
+    Return a lock serializing downloads to C{path} within this process, to
+    go with the L{LockFile}.
+    """
+    with _downloadLocksLock:
+        return _downloadLocks.setdefault(path, threading.Lock())
+
+
+def _copyChunks(f_in, f_out, validator, chunkSize=65536):
+    """
+    Copy C{f_in} to C{f_out}, if given, passing the data through
+    C{validator}, if given.
+    """
+    while True:
+        data = f_in.read(chunkSize)
+        if not data:
+            break
+        if f_out:
+            f_out.write(data)
+        if validator:
+            validator.update(data)
+
+
+def _getRangeStart(response):
+    """
+    Return the offset of the first byte in a C{206 Partial Content} response,
+    or C{None} if C{response} is not for part of a file.
+    """
+    contentRange = _getHeader(response, 'Content-Range')
+    if not contentRange or not contentRange.startswith('bytes '):
+        return None
+    try:
+        return int(contentRange[6:].split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def _getHeader(response, name):
+    """Return the value of header C{name} from a HTTP response, if present"""
+    for attr in ('headers', 'msg'):
+        headers = getattr(response, attr, None)
+        if headers is not None and hasattr(headers, 'get'):
+            return headers.get(name)
+    return None
+
+
+def prefetchTips(repos):
+    """
+    Resolve the tips of many L{WmsRepository} objects at once, so that their
+    C{setFromTip} does not need a round trip of its own.
+    """
+    repos = [x for x in repos if x._tip is None]
+    if not repos:
+        return
+    results = repos[0].wms.poll_many(
+            [(x.path, x.branch or 'HEAD') for x in repos])
+    for repo, result in zip(repos, results):
+        repo._tip = repo._findTip(result)
+
+
 class WmsClient(object):
 
     def __init__(self, cfg):
@@ -111,21 +277,39 @@ class WmsClient(object):
         base = URL(cfg.wmsBase)
         self.wmsUser = base.userpass
         self.base = base._replace(userpass=None)
-        self.opener = opener.URLOpener(followRedirects=True)
+        self.opener = getSession(cfg.wmsMaxConnections)
 
     # API
 
     def poll(self, repos, branch):
         data = self._open_repos(repos, ['poll', self._quote(branch)])
-        return [x.split() for x in data]
+        try:
+            return [x.split() for x in data]
+        finally:
+            data.close()
+
+    def poll_many(self, requests):
+        """
+        Poll several C{(repos, branch)} pairs concurrently, returning the
+        results of L{poll} for each in the same order.
+        """
+        unique = sorted(set(requests))
+        results = parallelMap(lambda x: self.poll(*x), unique,
+                self.opener.maxConnections)
+        results = dict(zip(unique, results))
+        return [results[x] for x in requests]
 
     def show_url(self, repos):
-        return self._open_repos(repos, ['show_url']).readline().strip()
+        fobj = self._open_repos(repos, ['show_url'])
+        try:
+            data = fobj.read()
+        finally:
+            fobj.close()
+        return data.split('\n', 1)[0].strip()
 
-    def archive(self, repos, ref, name, subtree=None):
-        subtrees = [subtree] if subtree else None
+    def archive(self, repos, ref, name, subtrees=None, **kwargs):
         return self._open_repos(repos, ['archive', ref,
-            name + self._q_subtrees(subtrees)])
+            name + self._q_subtrees(subtrees)], **kwargs)
 
     def create_token(self):
         if not self.wmsUser:
@@ -145,7 +329,7 @@ class WmsClient(object):
     def destroy_token(self, token):
         token = token[1]
         try:
-            self._open(['token', token], method='DELETE')
+            self._open(['token', token], method='DELETE').close()
         except http_error.ResponseError as err:
             if err.errcode not in (204, 404):
                 raise
@@ -194,4 +378,131 @@ class WmsClient(object):
             kwargs['data'] = json.dumps(json_data)
         fobj = self.opener.open(self.base.join('api/' + '/'.join(elems)),
                 **kwargs)
-        return json.load(fobj)
+        try:
+            return json.load(fobj)
+        finally:
+            fobj.close()
+
+
+class _URLOpener(opener.URLOpener):
+    '''
+    URL opener that also accepts C{206 Partial Content}, the reply to the
+    range request used to resume an archive download.
+    '''
+
+    def _handleError(self, req, response):
+        if response.status == 206:
+            return self._handleResponse(req, response)
+        return opener.URLOpener._handleError(self, req, response)
+
+
+class WmsSession(object):
+    '''
+    Pool of persistent HTTP connections shared by all WMS clients in the
+    process. At most C{maxConnections} requests to any one host are in
+    flight at once; further requests wait for a connection to be returned.
+    '''
+
+    def __init__(self, maxConnections):
+        self.maxConnections = maxConnections
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _getHost(self, url):
+        hostport = getattr(url, 'hostport', None)
+        with self._lock:
+            if hostport not in self._hosts:
+                self._hosts[hostport] = (
+                        threading.BoundedSemaphore(self.maxConnections), [])
+            return self._hosts[hostport]
+
+    def open(self, url, **kwargs):
+        slots, idle = self._getHost(url)
+        slots.acquire()
+        try:
+            with self._lock:
+                urlOpener = idle and idle.pop() or None
+            if urlOpener is None:
+                urlOpener = _URLOpener(followRedirects=True, persist=True)
+            response = urlOpener.open(url, **kwargs)
+        except:
+            # Don't reuse a connection in an unknown state
+            slots.release()
+            raise
+
+        def release(reusable):
+            if reusable:
+                with self._lock:
+                    idle.append(urlOpener)
+            slots.release()
+        return PooledResponse(response, release)
+
+
+class PooledResponse(object):
+    '''
+    Wrapper around a HTTP response that hands its connection back to the
+    L{WmsSession} once the body has been read to the end or the response is
+    closed. Connections closed with unread data, or that failed while
+    reading, are discarded.
+    '''
+
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def _finish(self, reusable):
+        if self._release:
+            release, self._release = self._release, None
+            self._response.close()
+            release(reusable)
+
+    def read(self, size=-1):
+        try:
+            if size < 0:
+                data = self._response.read()
+            else:
+                data = self._response.read(size)
+        except:
+            self._finish(False)
+            raise
+        if not data or size < 0:
+            self._finish(True)
+        return data
+
+    def readline(self):
+        try:
+            line = self._response.readline()
+        except:
+            self._finish(False)
+            raise
+        if not line:
+            self._finish(True)
+        return line
+
+    def close(self):
+        self._finish(False)
+
+
+_session = None
+_sessionLock = threading.Lock()
+
+
+def getSession(maxConnections):
+    '''
+    Return the connection pool shared by all WMS clients in this process.
+    '''
+    global _session
+    with _sessionLock:
+        if _session is None:
+            _session = WmsSession(maxConnections)
+        return _session
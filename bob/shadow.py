@@ -20,11 +20,15 @@ Tools for manipulating recipes and source troves.
 '''
 
 import hashlib
-import inspect
 import logging
+import multiprocessing
 import os
+import re
 import shutil
+import sys
 import tempfile
+import traceback
+from multiprocessing.pool import ThreadPool
 
 from conary.build import cook
 from conary.build import lookaside
@@ -47,7 +51,8 @@ from conary.versions import Branch, Revision
 
 from bob import macro
 from bob.mangle import mangle
-from bob.util import checkBZ2
+from bob.summary import RecipeSummary
+from bob.util import ArchiveCheck, parallelMap
 
 log = logging.getLogger('bob.shadow')
 
@@ -56,10 +61,13 @@ log = logging.getLogger('bob.shadow')
 
 
 class ShadowBatch(object):
-    def __init__(self, helper):
+    def __init__(self, helper, metadataCache=None):
         self.helper = helper
+        self.metadataCache = metadataCache
         self.sources = set()
         self.oldChangeSet = None
+        self.oldFiles = None
+        self.recipeDir = None
 
         # Parallel lists
         self.packages = []
@@ -78,34 +86,154 @@ class ShadowBatch(object):
 
         self._makeProddef()
         self._makePlatdef()
-        self._makeRecipes()
-        if self.helper.plan.depMode:
-            return
-        self._fetchOldChangeSets()
-        self._merge()
+        try:
+            self._makeRecipes()
+            if self.helper.plan.depMode:
+                return
+            self._fetchOldChangeSets()
+            self._merge()
+        finally:
+            if self.recipeDir and not self.helper.plan.dumpRecipes:
+                shutil.rmtree(self.recipeDir)
+            self.recipeDir = None
 
     def _makeRecipes(self):
         """Take pristine upstream sources, mangle them, and load the result."""
         if self.helper.plan.dumpRecipes:
-            recipeDir = self.helper.plan.recipeDir
+            self.recipeDir = self.helper.plan.recipeDir
         else:
-            recipeDir = tempfile.mkdtemp(prefix='bob-')
+            self.recipeDir = tempfile.mkdtemp(prefix='bob-')
         # Dump all the recipes out at once in case they have interdependencies
         finalRecipes = []
         for package in self.packages:
             recipe = package.getRecipe()
             finalRecipe = mangle(package, recipe)
             package.recipeFiles[package.getRecipeName()] = finalRecipe
-            with open(os.path.join(recipeDir, package.getRecipeName()
-                    ), 'w') as fobj:
+            with open(self._getRecipePath(package), 'w') as fobj:
                 fobj.write(finalRecipe)
             finalRecipes.append(finalRecipe)
-        for package, finalRecipe in zip(self.packages, finalRecipes):
-            recipeObj = _loadRecipe(self.helper, package,
-                    os.path.join(recipeDir, package.getRecipeName()))
-            self.recipes.append((finalRecipe, recipeObj))
-        if not self.helper.plan.dumpRecipes:
-            shutil.rmtree(recipeDir)
+        loadDeps = _getLoadDependencies(self.packages, finalRecipes)
+        waves = _getLoadWaves(self.packages, loadDeps)
+        keys = self._getMetadataKeys(finalRecipes, loadDeps, waves)
+        summaries = self._loadSummaries(waves, keys)
+        self.recipes = zip(finalRecipes, summaries)
+
+    def _getRecipePath(self, package):
+        return os.path.join(self.recipeDir, package.getRecipeName())
+
+    def _getMetadataKeys(self, recipes, loadDeps, waves):
+        """
+        Return a key for each package that identifies everything its loaded
+        summary depends on: the mangled recipe, the recipes in this batch
+        that it loads, the factory, and the build configuration.
+        """
+        if self.metadataCache is None:
+            return None
+        cfg, plan = self.helper.cfg, self.helper.plan
+        common = [
+                str(RecipeSummary.FORMAT),
+                str(bool(plan.depMode)),
+                cfg.buildFlavor.freeze(),
+                plan.getTargetLabel().asString(),
+                ' '.join(str(x) for x in cfg.installLabelPath),
+                ] + ['%s=%s' % x for x in sorted(cfg.macros.items())]
+        keys = [None] * len(recipes)
+        for wave in waves:
+            for index in wave:
+                package = self.packages[index]
+                digest = hashlib.sha1()
+                for item in common + [
+                        package.name,
+                        str(package.targetConfig.factory),
+                        recipes[index],
+                        ]:
+                    digest.update(item + '\0')
+                for dep in sorted(loadDeps[index]):
+                    # Recipes loading each other in a cycle are in the same
+                    # wave, so fall back to the text of the other recipe.
+                    digest.update((keys[dep] or recipes[dep]) + '\0')
+                keys[index] = digest.hexdigest()
+        return keys
+
+    def _loadSummaries(self, waves, keys=None):
+        """
+        Load the recipes of all packages and return a L{RecipeSummary} for
+        each. C{waves} is a list of lists of package indices; each wave is
+        loaded only after the previous one has finished. With
+        C{loadWorkers} set, the recipes in a wave are loaded in a pool of
+        processes and only their summaries are sent back.
+
+        If C{keys} is given, summaries found in the metadata cache under the
+        key of a package are used instead of loading its recipe, and newly
+        loaded summaries are stored there.
+        """
+        summaries = [None] * len(self.packages)
+        if keys is not None:
+            for index, key in enumerate(keys):
+                summaries[index] = self.metadataCache.get(key)
+            hits = len([x for x in summaries if x is not None])
+            if hits:
+                log.info("Using cached metadata for %d of %d recipes",
+                        hits, len(summaries))
+            waves = [[x for x in wave if summaries[x] is None]
+                    for wave in waves]
+            waves = [x for x in waves if x]
+            if not waves:
+                return summaries
+        self._loadWaves(waves, summaries)
+        if keys is not None:
+            for wave in waves:
+                for index in wave:
+                    self.metadataCache.put(keys[index], summaries[index])
+        return summaries
+
+    def _loadWaves(self, waves, summaries):
+        workers = min(self.helper.plan.loadWorkers,
+                max(len(x) for x in waves))
+        if multiprocessing.current_process().daemon:
+            # Already in a pool worker (e.g. bob-deps), which may not fork.
+            workers = 1
+        jobs = [(self.helper, package, self._getRecipePath(package))
+                for package in self.packages]
+        if workers <= 1:
+            for wave in waves:
+                for index in wave:
+                    summaries[index] = _loadSummary(*jobs[index])
+            return
+        global _loadJobs
+        _loadJobs = jobs
+        pool = multiprocessing.Pool(workers, initializer=_initLoadWorker)
+        try:
+            for wave in waves:
+                results = pool.map(_loadSummaryInWorker, wave, chunksize=1)
+                for index, summary in zip(wave, results):
+                    summaries[index] = summary
+        finally:
+            pool.close()
+            pool.join()
+            _loadJobs = None
+
+    def _getRecipeObj(self, index):
+        """
+        Return the recipe object for the I{index}th package, loading it in
+        this process if it was loaded elsewhere.
+        """
+        summary = self.recipes[index][1]
+        if summary.recipeObj is None:
+            package = self.packages[index]
+            summary.recipeObj = _loadRecipe(self.helper, package,
+                    self._getRecipePath(package))
+        return summary.recipeObj
+
+    def _getSource(self, index, name):
+        """
+        Return the source action for the source file C{name} of the
+        I{index}th package.
+        """
+        recipeObj = self._getRecipeObj(index)
+        sources = dict((os.path.basename(x.getPath()), x)
+                for x in recipeObj.getSourcePathList())
+        return sources[name]
 
     def _makeProddef(self):
         pkg = self._getProddefPackage()
@@ -161,10 +289,10 @@ class ShadowBatch(object):
         results = self.helper.getRepos().findTroves(None, versionSpecs,
             allowMissing=True, getLeaves=False,
             troveTypes=trovesource.TROVE_QUERY_ALL)
-        for package, (recipeText, recipeObj), query in zip(
+        for package, (recipeText, summary), query in zip(
                 self.packages, self.recipes, versionSpecs):
             newVersion = _createVersion(package, self.helper,
-                    recipeObj.version)
+                    summary.version)
             existingVersions = [x[1] for x in results.get(query, ())]
             while newVersion in existingVersions:
                 newVersion.incrementSourceCount()
@@ -189,11 +317,12 @@ class ShadowBatch(object):
                 self.oldTroves.append(Trove(trvCs))
             else:
                 self.oldTroves.append(None)
+        self.oldFiles = FileIndex(self.oldChangeSet,
+                [x for x in self.oldTroves if x is not None])
 
     def _merge(self):
-        changeSet = ChangeSet()
+        plan = self.helper.plan
         deleteDirs = set()
-        doCommit = False
         # If this is not None then all ephemeral sources will still be fetched
         # but will be placed in this directory instead.
         if self.helper.plan.ephemeralSourceDir:
@@ -224,8 +353,22 @@ class ShadowBatch(object):
             filesToAdd[fileId] = (fileStream, fileHelper.contents, isText)
             newTrove.addFile(pathId, path, fileVersion, fileId)
 
-        for package, (recipeText, recipeObj), oldTrove in zip(
-                self.packages, self.recipes, self.oldTroves):
+        # Build the new troves and collect the autosources that have to be
+        # snapshotted first, then fetch all the snapshots at once.
+        pending = []
+        for index, (package, (recipeText, summary), oldTrove) in enumerate(
+                zip(self.packages, self.recipes, self.oldTroves)):
+            package.binaryNames = summary.packages
+
+            # Most of the time nothing changed, so check that before
+            # snapshotting any autosources.
+            if oldTrove and self._isUnchanged(package, summary, oldTrove,
+                    ephDir):
+                package.setDownstreamVersion(oldTrove.getVersion())
+                package.sourceReused = True
+                log.debug('Skipped %s=%s', oldTrove.getName(),
+                        oldTrove.getVersion())
+                continue
 
             filesToAdd = {}
             oldFiles = {}
@@ -243,56 +386,91 @@ class ShadowBatch(object):
                 isText = path == package.getRecipeName()
                 _addFile(path, contents, isText)
 
-            # Collect requested auto sources from recipe. Unknown recipe types
-            # will not be loaded so recipeObj will be the class, so assume
-            # these have no sources.
-            if not inspect.isclass(recipeObj):
-                recipeFiles = dict((os.path.basename(x.getPath()), x)
-                    for x in recipeObj.getSourcePathList())
+            # Collect requested auto sources from recipe.
+            snapshots = []
+            if summary.isLoaded:
+                recipeFiles = summary.getSources()
                 newFiles = set(x[1] for x in newTrove.iterFileList())
 
                 needFiles = set(recipeFiles) - newFiles
-                for autoPath in needFiles:
-                    source = recipeFiles[autoPath]
+                for autoPath in sorted(needFiles):
+                    sourcePath, ephemeral = recipeFiles[autoPath]
                     if (autoPath in oldFiles
                             and not self.helper.plan.refreshSources
-                            and not source.ephemeral):
+                            and not ephemeral):
                         # File exists in old version.
                         pathId, path, fileId, fileVer = oldFiles[autoPath]
                         newTrove.addFile(pathId, path, fileVer, fileId)
                         continue
 
-                    if source.ephemeral and not ephDir:
+                    if ephemeral and not ephDir:
                         continue
 
                     # File doesn't exist; need to create it.
-                    if source.ephemeral:
-                        laUrl = lookaside.laUrl(source.getPath())
+                    if ephemeral:
+                        laUrl = lookaside.laUrl(sourcePath)
                         tempDir = joinPaths(ephDir,
                                 os.path.dirname(laUrl.filePath()))
                         mkdirChain(tempDir)
                     else:
                         tempDir = tempfile.mkdtemp()
                         deleteDirs.add(tempDir)
-                    snapshot = _getSnapshot(self.helper, package, source,
-                            tempDir)
+                    source = self._getSource(index, autoPath)
+                    snapshots.append((autoPath, ephemeral, source, tempDir))
+
+            pending.append((package, oldTrove, newTrove, filesToAdd,
+                snapshots))
+
+        # One package at a time per worker, as its sources may share an SCM
+        def _snapshotPackage(item):
+            package, snapshots = item[0], item[4]
+            return [_getSnapshot(self.helper, package, source, tempDir)
+                    for _, _, source, tempDir in snapshots]
+        snapshotPaths = parallelMap(_snapshotPackage, pending,
+                self.helper.plan.snapshotWorkers)
+
+        commits = _CommitQueue(self.helper, self._commitChangeSet,
+                plan.commitWorkers)
+        try:
+            for changeSet, numTroves in self._buildChunks(pending,
+                    snapshotPaths):
+                commits.add(changeSet, numTroves)
+            commits.wait()
+        finally:
+            commits.close()
 
-                    if not source.ephemeral and snapshot:
-                        autoPathId = hashlib.md5(autoPath).digest()
-                        autoObj = FileFromFilesystem(snapshot, autoPathId)
-                        autoObj.flags.isAutoSource(set=True)
-                        autoObj.flags.isSource(set=True)
-                        autoFileId = autoObj.fileId()
+        for path in deleteDirs:
+            shutil.rmtree(path)
 
-                        autoContents = filecontents.FromFilesystem(snapshot)
-                        filesToAdd[autoFileId] = (autoObj, autoContents, False)
-                        newTrove.addFile(autoPathId, autoPath,
-                            newTrove.getVersion(), autoFileId)
+    def _buildChunks(self, pending, snapshotPaths):
+        '''
+        Finish the new source troves in C{pending} with their snapshots and
+        yield the changesets to commit as C{(changeSet, numTroves)}, split
+        according to C{commitChunkTroves} and C{commitChunkSize}.
+        '''
+        plan = self.helper.plan
+        changeSet = ChangeSet()
+        chunkTroves = chunkBytes = 0
+        for (package, oldTrove, newTrove, filesToAdd, snapshots), paths in zip(
+                pending, snapshotPaths):
+            for (autoPath, ephemeral, _, _), snapshot in zip(snapshots, paths):
+                if not ephemeral and snapshot:
+                    autoPathId = hashlib.md5(autoPath).digest()
+                    autoObj = FileFromFilesystem(snapshot, autoPathId)
+                    autoObj.flags.isAutoSource(set=True)
+                    autoObj.flags.isSource(set=True)
+                    autoFileId = autoObj.fileId()
+
+                    autoContents = filecontents.FromFilesystem(snapshot)
+                    filesToAdd[autoFileId] = (autoObj, autoContents, False)
+                    newTrove.addFile(autoPathId, autoPath,
+                        newTrove.getVersion(), autoFileId)
 
             # If the old and new troves are identical, just use the old one.
             if oldTrove and _sourcesIdentical(
-                    oldTrove, newTrove, [self.oldChangeSet, filesToAdd]):
+                    oldTrove, newTrove, self.oldFiles, filesToAdd):
                 package.setDownstreamVersion(oldTrove.getVersion())
+                package.sourceReused = True
                 log.debug('Skipped %s=%s', oldTrove.getName(),
                         oldTrove.getVersion())
                 continue
@@ -314,28 +492,161 @@ class ShadowBatch(object):
             newTrove.computeDigests()
             newTroveCs = newTrove.diff(None, absolute=True)[0]
             changeSet.newTrove(newTroveCs)
-            doCommit = True
 
             package.setDownstreamVersion(newTrove.getVersion())
             log.debug('Created %s=%s', newTrove.getName(), newTrove.getVersion())
 
-        if doCommit:
-            cook.signAbsoluteChangesetByConfig(changeSet, self.helper.cfg)
+            # Commit in chunks if the changeset got too big
+            chunkTroves += 1
+            chunkBytes += sum(x[0].contents.size()
+                    for x in filesToAdd.values())
+            if ((plan.commitChunkTroves
+                    and chunkTroves >= plan.commitChunkTroves)
+                    or (plan.commitChunkSize
+                    and chunkBytes >= plan.commitChunkSize * 1024 * 1024)):
+                yield changeSet, chunkTroves
+                changeSet = ChangeSet()
+                chunkTroves = chunkBytes = 0
+
+        if chunkTroves:
+            yield changeSet, chunkTroves
+
+    def _commitChangeSet(self, changeSet, helper=None):
+        '''
+        Commit C{changeSet}, leaving a copy of it in the current directory if
+        the commit fails. With C{streamCommit} the copy is only written after
+        a failure, instead of before every commit. C{helper} is used instead
+        of the batch's own helper if given.
+        '''
+        if helper is None:
+            helper = self.helper
+        def _saveChangeSet():
             f = tempfile.NamedTemporaryFile(dir=os.getcwd(), suffix='.ccs',
                     delete=False)
             f.close()
             changeSet.writeToFile(f.name)
+            return f.name
+
+        if helper.plan.streamCommit:
             try:
-                self.helper.getRepos().commitChangeSet(changeSet)
+                helper.getRepos().commitChangeSet(changeSet)
             except:
-                log.error("Error committing changeset to repository, "
-                        "failed changeset is saved at %s", f.name)
-                raise
-            else:
-                os.unlink(f.name)
+                exc_info = sys.exc_info()
+                try:
+                    path = _saveChangeSet()
+                except Exception:
+                    log.exception("Error saving failed changeset")
+                else:
+                    log.error("Error committing changeset to repository, "
+                            "failed changeset is saved at %s", path)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return
 
-        for path in deleteDirs:
-            shutil.rmtree(path)
+        path = _saveChangeSet()
+        try:
+            helper.getRepos().commitChangeSet(changeSet)
+        except:
+            log.error("Error committing changeset to repository, "
+                    "failed changeset is saved at %s", path)
+            raise
+        else:
+            os.unlink(path)
+
+    def _isUnchanged(self, package, summary, oldTrove, ephDir):
+        '''
+        Return C{True} if the new source trove for C{package} is certain to
+        have the same contents as C{oldTrove}, judging only by the recipe
+        files and the paths of the autosources.
+        '''
+        if self.helper.plan.refreshSources:
+            return False
+        if (oldTrove.getFactory() or None) != (
+                package.targetConfig.factory or None):
+            return False
+        expected = set(package.recipeFiles)
+        if summary.isLoaded:
+            for autoPath, (_, ephemeral) in summary.getSources().iteritems():
+                if autoPath in package.recipeFiles:
+                    continue
+                if not ephemeral:
+                    expected.add(autoPath)
+                elif ephDir:
+                    # Ephemeral sources still have to be fetched
+                    return False
+        oldPaths = dict((x[1], x[2]) for x in oldTrove.iterFileList())
+        if set(oldPaths) != expected:
+            return False
+        for path, contents in package.recipeFiles.iteritems():
+            fileId = oldPaths[path]
+            if fileId not in self.oldFiles:
+                return False
+            if self.oldFiles.getSHA1(fileId) != hashlib.sha1(
+                    contents).digest():
+                return False
+        return True
+
+
+class _CommitQueue(object):
+    '''
+    Sign and commit source changesets as they are added, calling
+    C{commit(changeSet, helper)} for up to C{workers} of them at once. Once a
+    commit fails, adding another raises its error instead of queuing more.
+    '''
+
+    def __init__(self, helper, commit, workers):
+        self.helper = helper
+        self.commit = commit
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPool(workers)
+        self.results = []
+        self.count = 0
+
+    def add(self, changeSet, numTroves):
+        self._checkFailed()
+        self.count += 1
+        args = (changeSet, numTroves, self.count)
+        if not self.pool:
+            self._commit(*args)
+            return
+        # Don't let built changesets pile up in memory behind slow commits
+        running = [x for x in self.results if not x.ready()]
+        if len(running) >= self.workers:
+            running[0].wait()
+            self._checkFailed()
+        self.results.append(self.pool.apply_async(self._commit, args))
+
+    def _checkFailed(self):
+        for result in self.results:
+            if result.ready() and not result.successful():
+                result.get()
+
+    def _commit(self, changeSet, numTroves, number):
+        helper = self.helper
+        if self.pool:
+            helper = helper.clone()
+        cook.signAbsoluteChangesetByConfig(changeSet, helper.cfg)
+        self.commit(changeSet, helper)
+        log.info("Committed source chunk %d (%d troves)", number, numTroves)
+
+    def close(self):
+        '''
+        Stop accepting changesets and wait for the commits in progress.
+        '''
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def wait(self):
+        '''
+        Wait for all commits to finish, raising the first error if any
+        failed.
+        '''
+        self.close()
+        for result in self.results:
+            result.get()
 
 
 def _createVersion(package, helper, version):
@@ -350,27 +661,62 @@ def _createVersion(package, helper, version):
     return newVersion
 
 
-def _sourcesIdentical(oldTrove, newTrove, changeSets):
+class FileIndex(object):
     '''
-    Return C{True} if C{oldTrove} and C{newTrove} have the same
-    contents.
+    The file streams of a set of troves in a changeset, indexed by fileId.
+    Streams are thawed on first lookup and the result is remembered, so
+    files that are never compared cost nothing.
     '''
-    def getSHA1(fileId):
-        for changeSet in changeSets:
-            if isinstance(changeSet, ChangeSet):
-                fileChange = changeSet.getFileChange(None, fileId)
-                if not fileChange:
-                    continue
 
-                fileObj = ThawFile(fileChange, None)
-                return fileObj.contents.sha1()
+    _missing = object()
+
+    def __init__(self, changeSet, troves):
+        self._changeSet = changeSet
+        self._fileIds = set()
+        for trv in troves:
+            self._fileIds.update(x[2] for x in trv.iterFileList())
+        self._sha1s = {}
+
+    def _lookup(self, fileId):
+        sha1 = self._sha1s.get(fileId, self._missing)
+        if sha1 is not self._missing:
+            return sha1
+        fileChange = None
+        if fileId in self._fileIds:
+            fileChange = self._changeSet.getFileChange(None, fileId)
+        if not fileChange:
+            sha1 = self._missing
+        else:
+            fileObj = ThawFile(fileChange, None)
+            if fileObj.hasContents:
+                sha1 = fileObj.contents.sha1()
             else:
-                fileObj = changeSet.get(fileId, None)
-                if not fileObj:
-                    continue
+                sha1 = None
+        self._sha1s[fileId] = sha1
+        return sha1
+
+    def __contains__(self, fileId):
+        return self._lookup(fileId) is not self._missing
+
+    def getSHA1(self, fileId):
+        sha1 = self._lookup(fileId)
+        if sha1 is self._missing:
+            raise KeyError(fileId)
+        return sha1
 
-                return fileObj[0].contents.sha1()
 
+def _sourcesIdentical(oldTrove, newTrove, oldFiles, newFiles):
+    '''
+    Return C{True} if C{oldTrove} and C{newTrove} have the same
+    contents. C{oldFiles} is a L{FileIndex} of the old changeset and
+    C{newFiles} maps fileIds of the files being added to tuples whose first
+    item is the file stream.
+    '''
+    def getSHA1(fileId):
+        if fileId in newFiles:
+            return newFiles[fileId][0].contents.sha1()
+        if fileId in oldFiles:
+            return oldFiles.getSHA1(fileId)
         raise KeyError("file is not in any changeset")
 
     if oldTrove.getFactory() != newTrove.getFactory():
@@ -460,6 +806,86 @@ def tempSourceTrove(recipePath, package, helper):
             conaryState.write(targetDir + '/CONARY')
     return trv, targetDir
 
+
+RE_LOAD = re.compile(
+        r'''\bload(?:SuperClass|Installed)\(\s*['"]([^'"]+)['"]''')
+
+
+def getLoadDependencies(recipe):
+    '''
+    Statically scan recipe text for C{loadSuperClass} and C{loadInstalled}
+    calls and return the set of package names they refer to.
+    '''
+    names = set()
+    for spec in RE_LOAD.findall(recipe):
+        name = spec.split('=')[0].split('[')[0].split(':')[0]
+        if name.endswith('.recipe'):
+            name = name[:-len('.recipe')]
+        names.add(name)
+    return names
+
+
+def _getLoadDependencies(packages, recipes):
+    '''
+    Return, for each of C{packages}, the set of indices of the packages in the
+    same batch whose recipes its recipe loads.
+    '''
+    byName = dict((x.getPackageName(), i) for i, x in enumerate(packages))
+    deps = []
+    for index, recipe in enumerate(recipes):
+        deps.append(set(byName[x] for x in getLoadDependencies(recipe)
+            if x in byName) - set([index]))
+    return deps
+
+
+def _getLoadWaves(packages, deps):
+    '''
+    Order the loading of C{packages} so that every recipe is loaded after the
+    recipes in the same batch that it loads, as given by C{deps}. Returns a
+    list of "waves" of package indices; the recipes in one wave do not depend
+    on each other.
+    '''
+    waves = []
+    done = set()
+    remaining = range(len(packages))
+    while remaining:
+        wave = [x for x in remaining if deps[x] <= done]
+        if not wave:
+            log.warning("Recipes %s load each other in a cycle",
+                    ' '.join(sorted(packages[x].getPackageName()
+                        for x in remaining)))
+            wave = remaining
+        waves.append(wave)
+        done.update(wave)
+        remaining = [x for x in remaining if x not in done]
+    return waves
+
+
+_loadJobs = None
+
+
+def _initLoadWorker():
+    # Don't share the parent's repository and rMake connections
+    helper = _loadJobs[0][0]
+    helper.configChanged()
+
+
+def _loadSummaryInWorker(index):
+    helper, package, recipePath = _loadJobs[index]
+    try:
+        return _loadSummary(helper, package, recipePath)
+    except Exception:
+        # The original exception may not survive pickling
+        raise RuntimeError("Failed to load recipe for %s:\n%s"
+                % (package.name, traceback.format_exc()))
+
+
+def _loadSummary(helper, package, recipePath):
+    recipeObj = _loadRecipe(helper, package, recipePath)
+    return RecipeSummary(recipeObj, analyzeGroup=helper.plan.depMode
+            and package.getPackageName().startswith('group-'))
+
+
 def _loadRecipe(helper, package, recipePath):
     # Load the recipe
     use.setBuildFlagsFromFlavor(package.getPackageName(),
@@ -541,10 +967,11 @@ def _getSnapshot(helper, package, source, tempDir):
     fullPath = source.getFilename()
     snapPath = os.path.join(tempDir, os.path.basename(fullPath))
     scm = package.getSCM()
+    verify = ArchiveCheck(snapPath)
     fetched = False
     if scm:
         try:
-            scm.fetchArchive(source, snapPath)
+            scm.fetchArchive(source, snapPath, verify=verify)
             fetched = True
         except NotImplementedError:
             pass
@@ -559,7 +986,8 @@ def _getSnapshot(helper, package, source, tempDir):
             source.updateArchive(repositoryDir)
         source.createSnapshot(repositoryDir, snapPath)
 
-    if fullPath.endswith('.bz2') and not checkBZ2(snapPath):
+    # Archives fetched from the SCM were already checked while downloading
+    if not fetched and not verify(snapPath):
         raise RuntimeError("Autosource file %r is corrupt!" % (snapPath,))
 
     return snapPath
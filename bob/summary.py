@@ -0,0 +1,144 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Picklable summaries of loaded recipes.
+'''
+
+import inspect
+import itertools
+import logging
+import os
+
+from conary.build import groupsetrecipe
+
+log = logging.getLogger('bob.summary')
+
+
+class RecipeSummary(object):
+    '''
+    The parts of a loaded recipe that bob uses after loading it: the version,
+    the sources it needs, and the packages or groups it produces. Unlike the
+    recipe object itself, a summary can be pickled, so it can be passed
+    between processes.
+
+    The recipe object is kept in C{recipeObj} when the summary was made in
+    this process, and is C{None} otherwise.
+    '''
+
+    # Bump when the attributes change so stale cached summaries are ignored
+    FORMAT = 2
+
+    def __init__(self, recipeObj, analyzeGroup=False):
+        self.recipeObj = recipeObj
+        # Unknown recipe types are not instantiated, so recipeObj will be the
+        # class. Assume these have no sources.
+        self.isLoaded = not inspect.isclass(recipeObj)
+        self.name = recipeObj.name
+        self.version = recipeObj.version
+        self.sources = []
+        self.packages = []
+        self.groupRequires = []
+        self.groupProvides = []
+        if self.isLoaded:
+            for source in recipeObj.getSourcePathList():
+                self.sources.append((os.path.basename(source.getPath()),
+                    source.getPath(), bool(source.ephemeral)))
+        if hasattr(recipeObj, 'packages'):
+            self.packages = sorted(recipeObj.packages)
+        elif hasattr(recipeObj, 'groups'):
+            self.packages = sorted(recipeObj.groups)
+        if analyzeGroup:
+            if hasattr(recipeObj, 'g'):
+                requires, provides = analyze_groupset(recipeObj)
+            else:
+                requires, provides = analyze_group(recipeObj)
+            self.groupRequires = requires
+            self.groupProvides = provides
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['recipeObj'] = None
+        return state
+
+    def getSources(self):
+        '''
+        Return a dictionary mapping the filename of each source to a tuple
+        C{(path, ephemeral)}.
+        '''
+        return dict((name, (path, ephemeral))
+                for name, path, ephemeral in self.sources)
+
+
+def analyze_group(recipeObj):
+    if not hasattr(recipeObj, 'getAdditionalSearchPath'):
+        log.warning("Recipe for %s does not have a "
+                "getAdditionalSearchPath method; cannot analyze "
+                "requirements.", recipeObj.name)
+        return [], []
+    path = recipeObj.getAdditionalSearchPath()
+    if not path:
+        log.warning("Recipe for %s does not have a "
+                "getAdditionalSearchPath method; cannot analyze "
+                "requirements.", recipeObj.name)
+        return [], []
+    requires = []
+    for item in itertools.chain(*path):
+        item = item.split('[')[0]
+        requires.append(item)
+    provides = []
+    for name in recipeObj.groups:
+        provides.append(name)
+    return requires, provides
+
+
+def analyze_groupset(recipeObj):
+    g = recipeObj.g
+    requires = []
+    for source in g.getRoots():
+        if isinstance(source, groupsetrecipe.GroupSearchSourceTroveSet):
+            label = source.searchSource.installLabelPath[0]
+            for child in g.getChildren(source):
+                if isinstance(child, groupsetrecipe.GroupSearchPathTroveSet):
+                    log.warning("Bare label %s is used as a search path. "
+                            "Troves found there will not be marked as "
+                            "requirements.", label)
+                    continue
+                if not hasattr(child, 'action'):
+                    log.warning("Don't know how to handle node of type '%s'",
+                            type(child).__name__)
+                    continue
+                if isinstance(child.action, groupsetrecipe.GroupFindAction):
+                    names = child.action.troveSpecs
+                else:
+                    log.warning("Don't know how to handle action of type '%s'",
+                            type(child.action).__name__)
+                    continue
+                for name in names:
+                    name = name.split('[')[0]
+                    if '=' not in name:
+                        name = '%s=%s' % (name, label)
+                    requires.append(name)
+        else:
+            log.warning("Don't know how to handle source of type '%s'",
+                    type(source).__name__)
+    provides = []
+    for node in g.iterNodes():
+        if isinstance(getattr(node, 'action', None),
+                groupsetrecipe.CreateGroupAction):
+            provides.append(node.action.name)
+    return requires, provides
@@ -19,6 +19,8 @@
 Internal representation of a build trove
 '''
 
+import copy
+
 from conary.deps.deps import Flavor
 
 from bob.config import BobTargetSection
@@ -49,6 +51,13 @@ class BobPackage(object):
         self.flavors = set()
         self.mangleData = None
         self.nextVersion = None
+        # True if the downstream version is an existing source trove
+        self.sourceReused = False
+        # True if a child was built in this run, so that existing builds of
+        # this group are out of date
+        self.childrenRebuilt = False
+        # Names of the packages or groups the recipe produces, if known
+        self.binaryNames = []
         self.trove = None
 
         # The 'after' target option acts as a list of additional children to
@@ -77,6 +86,13 @@ class BobPackage(object):
         '''
         return self.name.split(':')[0]
 
+    def getBinaryNames(self):
+        '''
+        Get the names of the packages or groups built from this source; e.g.
+        foobar and foobar-devel
+        '''
+        return self.binaryNames or [self.getPackageName()]
+
     def getRecipeName(self):
         '''
         Get the name of the package's recipe; e.g. foobar.recipe
@@ -168,6 +184,21 @@ class BobPackage(object):
         '''
         self.flavors = set(flavors)
 
+    def getFlavorView(self, flavor):
+        '''
+        Return a shallow copy of this package to be built in C{flavor}
+        only, e.g. for one batch of a serialized package. Everything but
+        the flavors and the C{flavor} option of the target configuration
+        is shared with this package.
+
+        @param flavor: The one flavor to build
+        '''
+        view = copy.copy(self)
+        view.setFlavors([flavor])
+        view.targetConfig = TargetConfigView(self.targetConfig,
+                flavor=[str(flavor)])
+        return view
+
     # Target configuration
     def getTargetConfig(self):
         '''
@@ -267,3 +298,26 @@ class BobPackage(object):
             raise RuntimeError("Trove %s references undefined "
                     "SCM repository %s" % (self.getPackageName(), name))
         return scmData[name]
+
+
+class TargetConfigView(object):
+    '''
+    A read-only view of a target configuration section in which some
+    options, given as keyword arguments, are replaced.
+    '''
+
+    def __init__(self, config, **overrides):
+        self._config = config
+        self._overrides = overrides
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self._overrides:
+            return self._overrides[name]
+        return getattr(self._config, name)
+
+    def __getitem__(self, name):
+        if name in self._overrides:
+            return self._overrides[name]
+        return self._config[name]
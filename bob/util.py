@@ -19,6 +19,7 @@
 Utility functions
 '''
 
+import bz2
 import errno
 import fcntl
 import logging
@@ -27,6 +28,8 @@ import subprocess
 import signal
 import tempfile
 import time
+import zlib
+from multiprocessing.pool import ThreadPool
 
 from conary import conaryclient
 from rmake.cmdline import helper
@@ -35,19 +38,162 @@ from conary.lib import util
 from conary.lib.digestlib import md5
 from conary.lib.util import statFile
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 log = logging.getLogger('bob.util')
 
 
-def checkBZ2(path):
+class ArchiveValidator(object):
     """
-    Validate that C{path} is a valid bzip2 file.
+    Check incrementally that the data passed to L{update} forms a complete,
+    intact compressed file of type C{kind}, one of C{'bz2'}, C{'gz'} or
+    C{'xz'}. Like the command-line tools, concatenated streams are accepted
+    and garbage after the last stream is ignored.
     """
-    devnull = open('/dev/null', 'w+')
-    proc = subprocess.Popen(['/usr/bin/bzip2', '-t', path], shell=False,
-            stdin=devnull, stdout=devnull, stderr=devnull)
-    proc.communicate()
-    return proc.returncode == 0
+
+    magic = {
+            'bz2': 'BZh',
+            'gz': '\x1f\x8b',
+            'xz': '\xfd7zXZ\x00',
+            }
+
+    def __init__(self, kind):
+        if kind == 'xz' and lzma is None:
+            raise ValueError("xz validation requires the lzma module")
+        self.kind = kind
+        self.ok = True
+        self._streams = 0
+        self._decomp = None
+        self._head = ''
+        self._trailing = False
+
+    def _newDecompressor(self):
+        if self.kind == 'bz2':
+            return bz2.BZ2Decompressor()
+        elif self.kind == 'gz':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+    def _decompress(self, data):
+        """
+        Feed C{data} to the current stream. Returns C{None} if the stream
+        has not ended yet, otherwise the data following it.
+        """
+        try:
+            self._decomp.decompress(data)
+        except EOFError:
+            # bz2 only notices the end of the stream on the next call
+            return data
+        if getattr(self._decomp, 'eof', False):
+            return self._decomp.unused_data
+        if self._decomp.unused_data:
+            return self._decomp.unused_data
+        return None
+
+    def update(self, data):
+        magic = self.magic[self.kind]
+        while data and self.ok and not self._trailing:
+            if self._decomp is None:
+                # Between streams, so this must be the start of another one
+                self._head += data
+                data = ''
+                if len(self._head) < len(magic) and magic.startswith(
+                        self._head):
+                    return
+                if not self._head.startswith(magic):
+                    if self._streams:
+                        self._trailing = True
+                    else:
+                        self.ok = False
+                    return
+                data, self._head = self._head, ''
+                self._decomp = self._newDecompressor()
+            try:
+                data = self._decompress(data)
+            except Exception:
+                self.ok = False
+                return
+            if data is not None:
+                self._decomp = None
+                self._streams += 1
+
+    def finish(self):
+        """
+        Return C{True} if all the data passed so far is valid.
+        """
+        if self.ok and self._decomp is not None:
+            # Only a finished stream leaves a following byte unconsumed
+            try:
+                self.ok = self._decompress('\0') is not None
+            except Exception:
+                self.ok = False
+            self._decomp = None
+            self._streams += 1
+        return self.ok and self._streams > 0
+
+
+class ArchiveCheck(object):
+    """
+    Check that files are intact compressed archives of the format given by
+    the extension of C{name}. An instance can be passed as the C{verify}
+    hook of L{ScmRepository.fetchArchive}: calling it checks a finished
+    file, and L{getValidator} lets the data be checked while it downloads.
+    """
+
+    def __init__(self, name):
+        self.kind = None
+        for suffix, kind in (
+                ('.bz2', 'bz2'),
+                ('.tbz2', 'bz2'),
+                ('.gz', 'gz'),
+                ('.tgz', 'gz'),
+                ('.xz', 'xz'),
+                ('.txz', 'xz'),
+                ):
+            if name.endswith(suffix):
+                self.kind = kind
+                break
+
+    def getValidator(self):
+        """
+        Return a new L{ArchiveValidator}, or C{None} if the format can't be
+        checked in this process.
+        """
+        if self.kind is None or (self.kind == 'xz' and lzma is None):
+            return None
+        return ArchiveValidator(self.kind)
+
+    def __call__(self, path):
+        validator = self.getValidator()
+        if validator is not None:
+            return _checkFile(path, validator)
+        if self.kind == 'xz':
+            # No lzma module, so fall back to the xz tool
+            devnull = open('/dev/null', 'w+')
+            proc = subprocess.Popen(['xz', '-t', path], shell=False,
+                    stdin=devnull, stdout=devnull, stderr=devnull)
+            proc.communicate()
+            return proc.returncode == 0
+        return True
+
+
+def _checkFile(path, validator, chunkSize=65536):
+    with open(path, 'rb') as fobj:
+        while True:
+            data = fobj.read(chunkSize)
+            if not data:
+                break
+            validator.update(data)
+            if not validator.ok:
+                return False
+    return validator.finish()
 
 
 class ClientHelper(object):
@@ -78,6 +224,16 @@ class ClientHelper(object):
         self._rmakeClient = None
         self._rmakeHelper = None
 
+    def clone(self):
+        '''
+        Return a helper with the same configuration but its own clients,
+        for use from another thread. The repository and rMake clients hold a
+        connection each, so threads must not share them.
+        '''
+        other = ClientHelper(self.cfg, self.plan, self.pluginMgr)
+        other.ephemeralDir = self.ephemeralDir
+        return other
+
     def getClient(self):
         '''Get a ConaryClient'''
         if not self._conaryClient:
@@ -283,6 +439,27 @@ def popStopHandler():
     return oldHandler
 
 
+def parallelMap(func, items, workers=1):
+    '''
+    Return C{map(func, items)}, running up to C{workers} calls at once in a
+    pool of threads. Results are always returned in the order of C{items},
+    and the first exception raised by any call is re-raised in the caller.
+
+    Threads suit work that is dominated by subprocesses and network I/O,
+    such as SCM operations and downloads, which don't hold the GIL.
+    '''
+    items = list(items)
+    workers = min(workers or 1, len(items))
+    if workers <= 1:
+        return [func(x) for x in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def reportCommitMap(commitMap):
     '''
     Print out a commit map in the form of a listing of sources and
@@ -330,6 +507,10 @@ class LockFile(object):
     Protect a code block with an exclusive file lock. Can be used as a context
     manager, or standalone.
 
+    The lock belongs to the process, so it does not exclude other threads of
+    the same process. Code that locks from several threads must also hold a
+    threading lock for the same path.
+
     >>> with LockFile(path):
     ...     do_stuff()
     """
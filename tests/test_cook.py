@@ -0,0 +1,71 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+from conary import versions
+from conary.deps.deps import parseFlavor as F
+
+from bob import cook
+
+
+X86 = F('is: x86(i486,i586,i686,sse,sse2)')
+X86_64 = F('is: x86(i486,i586,i686,sse,sse2) x86_64')
+
+
+class FakePackage(object):
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+    def getPackageName(self):
+        return self.name
+
+    def getBinaryNames(self):
+        return [self.name]
+
+    def getDownstreamVersion(self):
+        return self.version
+
+
+class FindExistingBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.package = FakePackage('foo',
+                versions.VersionFromString('/example.com@ex:devel/1.0-1'))
+        self.built = versions.VersionFromString(
+                '/example.com@ex:devel/1.0-1-1')
+
+    def testOnlyX86Built(self):
+        available = {'foo': {self.built: [F('is: x86(i486,i586,i686)')]}}
+        self.assertEqual(cook._findExistingBuild(self.package, available,
+            X86), [('foo', self.built, F('is: x86(i486,i586,i686)'))])
+        # The 32-bit binary must not stand in for the x86_64 build
+        self.assertEqual(cook._findExistingBuild(self.package, available,
+            X86_64), None)
+
+    def testBothBuilt(self):
+        available = {'foo': {self.built: [
+            F('is: x86(i486,i586,i686)'), F('is: x86_64')]}}
+        self.assertEqual(cook._findExistingBuild(self.package, available,
+            X86), [('foo', self.built, F('is: x86(i486,i586,i686)'))])
+        self.assertEqual(cook._findExistingBuild(self.package, available,
+            X86_64), [('foo', self.built, F('is: x86_64'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from bob.scm import git
+
+
+class ReadArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.workDir, 'foo'))
+        with open(os.path.join(self.workDir, 'foo', 'foo.recipe'), 'w') as f:
+            f.write('class Foo(PackageRecipe): pass\n')
+        self._git('init', '-q')
+        self._git('add', 'foo')
+        self._git('-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                'commit', '-qm', 'Add foo')
+
+        self.repo = git.GitRepository(self.workDir, '/example/repo', 'master')
+        self.repo.repoDir = self.workDir
+        self.repo.revision = self._git('rev-parse', 'HEAD').strip()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def _git(self, *args):
+        proc = subprocess.Popen(['git'] + list(args), cwd=self.workDir,
+                stdout=subprocess.PIPE)
+        stdout, _ = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        return stdout
+
+    def testReadArchive(self):
+        recipes = self.repo.readArchive(['foo'])
+        self.assertEqual(recipes.keys(), ['foo'])
+        self.assertEqual(recipes['foo'].keys(), ['foo.recipe'])
+
+    def testBadSubpath(self):
+        try:
+            self.repo.readArchive(['bar'])
+        except RuntimeError as err:
+            self.assertIn('exited with status', str(err))
+            self.assertIn('bar', str(err))
+        else:
+            self.fail("readArchive did not fail")
+
+
+if __name__ == '__main__':
+    unittest.main()
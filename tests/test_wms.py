@@ -0,0 +1,99 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from conary.lib.http import http_error
+
+from bob.scm import wms
+
+
+class FakeResponse(StringIO):
+
+    def __init__(self, data, headers=None):
+        StringIO.__init__(self, data)
+        self.headers = headers or {}
+
+
+class FakeClient(object):
+    '''
+    Serves C{data} as an archive, honoring range requests unless told to
+    reply with C{errcode} or with the whole file instead.
+    '''
+
+    def __init__(self, data, errcode=None, ignoreRange=False):
+        self.data = data
+        self.errcode = errcode
+        self.ignoreRange = ignoreRange
+        self.requests = []
+
+    def archive(self, path, ref, name, headers=()):
+        ranges = [x[1] for x in headers if x[0] == 'Range']
+        self.requests.append(ranges and ranges[0] or None)
+        if not ranges or self.ignoreRange:
+            return FakeResponse(self.data)
+        if self.errcode:
+            raise http_error.ResponseError('http://wms/', None, self.errcode,
+                    'Error')
+        start = int(ranges[0][6:-1])
+        return FakeResponse(self.data[start:], {'Content-Range':
+            'bytes %d-%d/%d' % (start, len(self.data) - 1, len(self.data))})
+
+
+class DownloadTest(unittest.TestCase):
+
+    data = '0123456789' * 100
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.partPath = os.path.join(self.workDir, 'archive.part')
+        with open(self.partPath, 'wb') as fobj:
+            fobj.write(self.data[:300])
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def _download(self, client):
+        repo = wms.WmsRepository.__new__(wms.WmsRepository)
+        repo.wms = client
+        repo.path = 'silo/repo'
+        repo.revision = 'a' * 40
+        repo._download('archive.tar', self.partPath, None)
+        with open(self.partPath, 'rb') as fobj:
+            return fobj.read()
+
+    def testResume(self):
+        client = FakeClient(self.data)
+        self.assertEqual(self._download(client), self.data)
+        self.assertEqual(client.requests, ['bytes=300-'])
+
+    def testRangeIgnored(self):
+        client = FakeClient(self.data, ignoreRange=True)
+        self.assertEqual(self._download(client), self.data)
+        self.assertEqual(client.requests, ['bytes=300-', None])
+
+    def testResumeFailed(self):
+        client = FakeClient(self.data, errcode=500)
+        self.assertEqual(self._download(client), self.data)
+        self.assertEqual(client.requests, ['bytes=300-', None])
+
+
+if __name__ == '__main__':
+    unittest.main()